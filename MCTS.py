@@ -5,14 +5,27 @@ import time
 from typing import Callable, Literal, Union
 import pickle
 import functools
-from copy import deepcopy
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from tqdm import trange
-from graphviz import Digraph
+from graphviz import Digraph, Source
 import numpy as np
 
+import metrics
+from metrics import Metrics
+from util import History, render_turn
+import treefile
+
 # FORCE_EXTEND = True
 FORCE_EXTEND = False
+# strategy children generated at once when FORCE_EXTEND is on, 1 keeps the serial loop
+EXTEND_WORKERS = 8
+# reward counted for each in-flight worker below a node in tree-parallel mode
+VIRTUAL_LOSS = 3
+# processes running `dot` for background draws
+RENDER_WORKERS = 2
 
 SHORT_MAP = {
     'Emotional Validation': 'Emotional Valid',
@@ -28,7 +41,32 @@ SHORT_MAP = {
 
 
 
+_render_pool = None
+_render_lock = threading.Lock()
+
+
+def _render(source, save_path, format):
+    Source(source).render(save_path, format=format, view=False)
+
+
+def render_pool():
+    global _render_pool
+    with _render_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _render_pool
+
+
 class Node:
+    # tree-parallel bookkeeping, history caches and the cached rollout, not saved with the tree
+    virtual_loss = 0
+    pending = False
+    _turns = None
+    _text = None
+    rollout = None
+    # (N, Q) build_from_json seeded the node with, convergence checks only count the visits on top of it
+    seed = None
+
     def __init__(self, parent: "Node", strategy, strategy_score: float, c) -> None:
         self.parent = parent
         self.children: list["Node"] = []
@@ -48,6 +86,7 @@ class Node:
         self.assistant = assistant
         self.user = user
         self.end = end
+        self._turns = self._text = None
 
     @property
     def id(self) -> str:
@@ -59,10 +98,26 @@ class Node:
             return f'PUCB:{self.PUCB:.4f}\nscore:{self.strategy_score:.4f}\n{SHORT_MAP[self.strategy]}\nQ:{self.Q:.4f}\nN:{self.N}'
         return f'PUCB:{self.PUCB:.4f}\nscore:{self.strategy_score:.4f}\n{SHORT_MAP[self.strategy]}\nQ:{self.Q:.4f}\nN:{self.N}'
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('virtual_loss', 'pending', '_turns', '_text', 'rollout'):
+            state.pop(k, None)
+        return state
+
     def _update_PUCB(self):
-        self.PUCB = self.Q + self.c * self.strategy_score * math.sqrt(self.parent.N) / (self.N + 1)
+        N = self.N + self.virtual_loss
+        Q = (self.Q * self.N - VIRTUAL_LOSS * self.virtual_loss) / N if N else self.Q
+        self.PUCB = Q + self.c * self.strategy_score * math.sqrt(self.parent.N + self.parent.virtual_loss) / (N + 1)
         return self
 
+    def add_virtual_loss(self, n):
+        node = self
+        while node is not None:
+            node.virtual_loss += n
+            for child in node.children:
+                child._update_PUCB()
+            node = node.parent
+
     def backward(self, reward):
         self.Q = (self.Q * self.N + reward) / (self.N + 1)
         self.N += 1
@@ -73,17 +128,37 @@ class Node:
             return
         self.parent.backward(reward)
 
-    def build_history(self):
-        if self.parent is None:
-            return [
+    def history_turns(self):
+        # shared tuple of turns from the root, each node adds its two turns to its parent's
+        if self._turns is None:
+            turns = (
                 {"role": "supporter", "content": self.assistant, "strategy": self.strategy},
                 {"role": "user", "content": self.user},
-            ]
-        return self.parent.build_history() + [
-            {"role": "supporter", "content": self.assistant, "strategy": self.strategy},
-            {"role": "user", "content": self.user},
-        ]
+            )
+            self._turns = turns if self.parent is None else self.parent.history_turns() + turns
+        return self._turns
+
+    def transcript(self, strategy=False):
+        # history_to_str text of build_history() with its trailing newline
+        if self._text is None:
+            self._text = {}
+        if strategy not in self._text:
+            prefix = '' if self.parent is None else self.parent.transcript(strategy)
+            self._text[strategy] = prefix + ''.join(render_turn(h, strategy) for h in self.history_turns()[-2:])
+        return self._text[strategy]
+
+    def build_history(self):
+        turns = self.history_turns()
+        return History(turns, base=(len(turns), self.transcript))
     
+    def path(self):
+        path = []
+        node = self
+        while node.parent is not None:
+            path.append(node.parent.children.index(node))
+            node = node.parent
+        return path[::-1]
+
     def count_end(self):
         if self.end:
             return 1
@@ -92,10 +167,322 @@ class Node:
             num += c.count_end()
         return num
 
+    def select(self):
+        node = self
+        while not len(node.children) == 0:
+            node = max(node.children, key=lambda child: child.PUCB)
+        return node
+
+
+class ChildList(list):
+    # children of a NodeView, appending also links the child in the store
+    def __init__(self, node: "NodeView", children) -> None:
+        super().__init__(children)
+        self.node = node
+
+    def append(self, child: "NodeView"):
+        super().append(child)
+        self.node.store.children[self.node.idx].append(child.idx)
+
+    def extend(self, children):
+        children = list(children)
+        super().extend(children)
+        self.node.store.children[self.node.idx].extend(c.idx for c in children)
+
+
+class TreeStore:
+    # struct-of-arrays tree: statistics live in numpy arrays indexed by node, dialogue text in side lists
+    FIELDS = {
+        "parent": np.int32, "N": np.int64, "Q": np.float64, "PUCB": np.float64, "strategy_score": np.float64,
+        "strategy_id": np.int16, "end": np.bool_, "is_extend": np.bool_, "virtual_loss": np.int32, "pending": np.bool_,
+    }
+
+    def __init__(self, c, capacity=64) -> None:
+        self.c = c
+        self.size = 0
+        self.strategies: list[str] = []
+        self._strategy_ids: dict[str, int] = {}
+        self.children: list[list[int]] = []
+        self.assistant: list = []
+        self.user: list = []
+        self.extra: dict[int, dict] = {}
+        self._turns: dict[int, tuple] = {}
+        self._text: dict[tuple[int, bool], str] = {}
+        self._rollouts: dict[int, list] = {}
+        for name, dtype in self.FIELDS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_lock', '_turns', '_text', '_rollouts'):
+            state.pop(k)
+        for name in self.FIELDS:
+            state[name] = state[name][:self.size].copy()
+        state['virtual_loss'][:] = 0
+        state['pending'][:] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        self._turns = {}
+        self._text = {}
+        self._rollouts = {}
+
+    def add(self, parent: "NodeView", strategy, strategy_score) -> "NodeView":
+        with self._lock:
+            if self.size == len(self.N):
+                for name in self.FIELDS:
+                    array = getattr(self, name)
+                    setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+            if strategy not in self._strategy_ids:
+                self._strategy_ids[strategy] = len(self.strategies)
+                self.strategies.append(strategy)
+            idx = self.size
+            self.size += 1
+            self.children.append([])
+            self.assistant.append(None)
+            self.user.append(None)
+            self.parent[idx] = -1 if parent is None else parent.idx
+            self.strategy_id[idx] = self._strategy_ids[strategy]
+            self.strategy_score[idx] = strategy_score
+        return NodeView(self, idx)
+
+    def refresh(self, idx):
+        ch = self.children[idx]
+        if not ch:
+            return
+        N = self.N[ch] + self.virtual_loss[ch]
+        Q = np.where(N > 0, (self.Q[ch] * self.N[ch] - VIRTUAL_LOSS * self.virtual_loss[ch]) / np.maximum(N, 1), self.Q[ch])
+        self.PUCB[ch] = Q + self.c * self.strategy_score[ch] * math.sqrt(self.N[idx] + self.virtual_loss[idx]) / (N + 1)
+
+    def select(self, idx=0):
+        children = self.children[idx]
+        while children:
+            idx = children[int(np.argmax(self.PUCB[children]))]
+            children = self.children[idx]
+        return idx
+
+    def backward(self, idx, reward):
+        with self._lock:
+            while idx >= 0:
+                self.Q[idx] = (self.Q[idx] * self.N[idx] + reward) / (self.N[idx] + 1)
+                self.N[idx] += 1
+                self.refresh(idx)
+                idx = self.parent[idx]
+
+    def add_virtual_loss(self, idx, n):
+        with self._lock:
+            while idx >= 0:
+                self.virtual_loss[idx] += n
+                self.refresh(idx)
+                idx = self.parent[idx]
+
+    def history_turns(self, idx):
+        chain = []
+        while idx >= 0 and idx not in self._turns:
+            chain.append(idx)
+            idx = self.parent[idx]
+        turns = () if idx < 0 else self._turns[idx]
+        for i in reversed(chain):
+            turns = turns + (
+                {"role": "supporter", "content": self.assistant[i], "strategy": self.strategies[self.strategy_id[i]]},
+                {"role": "user", "content": self.user[i]},
+            )
+            self._turns[i] = turns
+        return turns
+
+    def transcript(self, idx, strategy=False):
+        chain = []
+        while idx >= 0 and (idx, strategy) not in self._text:
+            chain.append(idx)
+            idx = self.parent[idx]
+        text = '' if idx < 0 else self._text[(idx, strategy)]
+        for i in reversed(chain):
+            text += ''.join(render_turn(h, strategy) for h in self.history_turns(i)[-2:])
+            self._text[(i, strategy)] = text
+        return text
+
+    @classmethod
+    def from_node(cls, root: Node) -> "NodeView":
+        store = cls(root.c)
+        stack = [(root, None)]
+        while stack:
+            node, parent = stack.pop()
+            view = store.add(parent, node.strategy, node.strategy_score)
+            if parent is not None:
+                store.children[parent.idx].append(view.idx)
+            view.N, view.Q, view.PUCB, view.end = node.N, node.Q, node.PUCB, node.end
+            if node.seed is not None:
+                view.seed = node.seed
+            if node.is_extend:
+                view.extend(assistant=node.assistant, user=node.user, end=node.end)
+            stack.extend((child, view) for child in reversed(node.children))
+        return NodeView(store, 0)
+
+    @classmethod
+    def from_file(cls, tree: treefile.TreeFile) -> "NodeView":
+        # statistics are copied out of the mapping so the tree can keep growing, text stays mapped until read
+        store = cls(tree.header["c"])
+        store.size = tree.header["size"]
+        for name, dtype in cls.FIELDS.items():
+            setattr(store, name, tree.column(name).copy() if name in treefile.STATS else np.zeros(store.size, dtype=dtype))
+        store.strategies = list(tree.header["strategies"])
+        store._strategy_ids = {s: i for i, s in enumerate(store.strategies)}
+        store.children = tree.children()
+        store.assistant, store.user = tree.text("assistant"), tree.text("user")
+        store.extra = {int(k): v for k, v in tree.header["extra"].items()}
+        return NodeView(store, 0)
+
+
+def _array_field(name):
+    def getter(self):
+        return getattr(self.store, name)[self.idx].item()
+
+    def setter(self, value):
+        # arrays are swapped when the store grows, so writes hold its lock
+        with self.store._lock:
+            getattr(self.store, name)[self.idx] = value
+    return property(getter, setter)
+
+
+class NodeView:
+    # Node-like handle on one row of a TreeStore, so build_data and MCTS can use either tree
+    __slots__ = ('store', 'idx')
+
+    N = _array_field('N')
+    Q = _array_field('Q')
+    PUCB = _array_field('PUCB')
+    strategy_score = _array_field('strategy_score')
+    end = _array_field('end')
+    is_extend = _array_field('is_extend')
+    virtual_loss = _array_field('virtual_loss')
+    pending = _array_field('pending')
+
+    def __init__(self, store: TreeStore, idx: int) -> None:
+        object.__setattr__(self, 'store', store)
+        object.__setattr__(self, 'idx', idx)
+
+    def __reduce__(self):
+        return NodeView, (self.store, self.idx)
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and other.store is self.store and other.idx == self.idx
+
+    def __hash__(self):
+        return hash((id(self.store), self.idx))
+
+    def __getattr__(self, name):
+        try:
+            return self.store.extra[self.idx][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        if hasattr(NodeView, name):
+            object.__setattr__(self, name, value)
+        else:
+            self.store.extra.setdefault(self.idx, {})[name] = value
+
+    @property
+    def parent(self):
+        parent = self.store.parent[self.idx]
+        return None if parent < 0 else NodeView(self.store, int(parent))
+
+    @property
+    def children(self):
+        return ChildList(self, [NodeView(self.store, i) for i in self.store.children[self.idx]])
+
+    @property
+    def strategy(self):
+        return self.store.strategies[self.store.strategy_id[self.idx]]
+
+    @property
+    def c(self):
+        return self.store.c
+
+    @property
+    def bad_list(self):
+        return []
+
+    @property
+    def assistant(self):
+        return self.store.assistant[self.idx]
+
+    @property
+    def user(self):
+        return self.store.user[self.idx]
+
+    @property
+    def id(self) -> str:
+        return f'{id(self.store)}_{self.idx}'
+
+    @property
+    def rollout(self):
+        return self.store._rollouts.get(self.idx)
+
+    @rollout.setter
+    def rollout(self, chain):
+        if chain is None:
+            self.store._rollouts.pop(self.idx, None)
+        else:
+            self.store._rollouts[self.idx] = chain
+
+    label = Node.label
+    path = Node.path
+
+    def extend(self, assistant, user, end):
+        with self.store._lock:
+            self.store.assistant[self.idx] = assistant
+            self.store.user[self.idx] = user
+            self.is_extend = True
+            self.end = end
+            self.store._turns.pop(self.idx, None)
+            self.store._text.pop((self.idx, False), None)
+            self.store._text.pop((self.idx, True), None)
+
+    def _update_PUCB(self):
+        N = self.N + self.virtual_loss
+        Q = (self.Q * self.N - VIRTUAL_LOSS * self.virtual_loss) / N if N else self.Q
+        parent = self.parent
+        self.PUCB = Q + self.c * self.strategy_score * math.sqrt(parent.N + parent.virtual_loss) / (N + 1)
+        return self
+
+    def add_virtual_loss(self, n):
+        self.store.add_virtual_loss(self.idx, n)
+
+    def backward(self, reward):
+        self.store.backward(self.idx, reward)
+
+    def select(self):
+        return NodeView(self.store, self.store.select(self.idx))
+
+    def history_turns(self):
+        return self.store.history_turns(self.idx)
+
+    def transcript(self, strategy=False):
+        return self.store.transcript(self.idx, strategy)
+
+    def build_history(self):
+        turns = self.store.history_turns(self.idx)
+        return History(turns, base=(len(turns), self.transcript))
+
+    def count_end(self):
+        num = 0
+        stack = [self.idx]
+        while stack:
+            idx = stack.pop()
+            if self.store.end[idx]:
+                num += 1
+            else:
+                stack.extend(self.store.children[idx])
+        return num
+
 
 
 class MCTS:
-    def __init__(self, init_assistant='', c=10, sim_max_round: Union[int, Literal['end']]='end', gen_strategy_fn=None, gen_assistant_fn=None, gen_user_fn=None, eval_all_fn=None, rw_bias=0) -> None:
+    def __init__(self, init_assistant='', c=10, sim_max_round: Union[int, Literal['end']]='end', gen_strategy_fn=None, gen_assistant_fn=None, gen_user_fn=None, eval_all_fn=None, rw_bias=0, workers=1, checkpoint: Literal['pickle', 'journal']='pickle', snapshot_every=20, render: Literal['never', 'every', 'final']='every', render_every=1, tree_store: Literal['node', 'array']='node', reuse_rollouts=False, converge_patience=0, converge_min_iter=0, converge_delta=0.1, reward_range=4, converge_tol=0.05, converge_min_visits=10) -> None:
         self.init_assistant = init_assistant
         self.c = c
         self.sim_max_round = sim_max_round
@@ -104,53 +491,161 @@ class MCTS:
         self.raw_gen_user_fn: Callable[[list, str, str, bool], tuple[str, bool]] = gen_user_fn
         self.eval_all_fn: Callable[[list], float] = eval_all_fn
         self.rw_bias = rw_bias
+        # workers > 1 runs that many select/expand/simulate/backward passes on the tree at once
+        self.workers = workers
+        self._cond = threading.Condition()
+        # 'journal' appends tree events every iteration and only pickles the whole tree every snapshot_every iterations
+        self.checkpoint = checkpoint
+        self.snapshot_every = snapshot_every
+        self._journal = None
+        self._seq = 0
+        # 'every' draws the tmp picture in the background every render_every iterations, 'final' and 'never' skip it during run
+        self.render = render
+        self.render_every = render_every
+        self._renders = {}
+        # end leaves in the tree, kept up to date by _extend and _attach instead of walking the tree
+        self.end_num = 0
+        # 'array' keeps new trees in a TreeStore instead of linked Node objects
+        self.tree_store = tree_store
+        # keep each rollout on the node it started from: expanding that node reuses its strategy scores and the
+        # child on the rollout's strategy reuses its turn, passing the rest of the rollout further down
+        self.reuse_rollouts = reuse_rollouts
+        # converge_patience > 0 also stops (once converge_min_iter and min_end are reached) when, for that many iterations,
+        # the root kept its best child and each node of the best path taken at the start of that streak kept its share of
+        # its siblings' visits and its Q (as a fraction of reward_range) within converge_tol, and the root's best child is
+        # the most visited one and separated by Hoeffding bounds at confidence 1 - converge_delta from every sibling with
+        # converge_min_visits visits. Levels and siblings below converge_min_visits are left out (PUCB has not found them
+        # worth visiting), and only backpropagated visits count
+        self.converge_patience = converge_patience
+        self.converge_min_iter = converge_min_iter
+        self.converge_delta = converge_delta
+        self.reward_range = reward_range
+        self.converge_tol = converge_tol
+        self.converge_min_visits = converge_min_visits
+        self._reference = None
+        self._stable = 0
+        # why the last run stopped: 'min_iter_and_end', 'max_end', 'max_iter', 'converged' or 'error', saved with the tree
+        self.stop_reason = None
+
+    def _new_node(self, parent, strategy, strategy_score):
+        if parent is None:
+            if self.tree_store == 'array':
+                return TreeStore(self.c).add(None, strategy, strategy_score)
+            return Node(parent=None, strategy=strategy, strategy_score=strategy_score, c=self.c)
+        if isinstance(parent, NodeView):
+            return parent.store.add(parent, strategy, strategy_score)
+        return Node(parent=parent, strategy=strategy, strategy_score=strategy_score, c=self.c)
+
+    def compact(self):
+        if not isinstance(self.tree, NodeView):
+            self.tree = TreeStore.from_node(self.tree)
+        self.tree_store = 'array'
+        return self
 
     def _reward(self, sim_history, sim_round):
         r = self.eval_all_fn(sim_history, sim_round)
         return r + self.rw_bias
     
-    def extend_node(self, node: Node):
+    def _take_rollout(self, parent: Node, strategy):
+        # first rollout turn cached on parent if it went down `strategy`, the remaining turns move to the child
+        chain = parent.rollout if self.reuse_rollouts and parent is not None else None
+        if not chain or chain[0]['strategy'] != strategy:
+            return None, None
+        parent.rollout = None
+        return chain[0], chain[1:] or None
+
+    def _gen_turn(self, node: Node):
+        step, rest = self._take_rollout(node.parent, node.strategy)
+        if step is not None:
+            node.rollout = rest
+            return step['assistant'], step['user'], step['end']
         history = node.parent.build_history()
         assistant = self.gen_assistant_fn(history, node.strategy)
         user, end = self.gen_user_fn(history + [{"role": "supporter", "content": assistant, "strategy": node.strategy}])
-        node.extend(assistant=assistant, user=user, end=end)
+        return assistant, user, end
+
+    def extend_node(self, node: Node):
+        assistant, user, end = self._gen_turn(node)
+        self._extend(node, assistant, user, end)
+
+    def _extend(self, node: Node, assistant, user, end):
+        with self._cond:
+            self._log({"op": "extend", "path": node.path(), "assistant": assistant, "user": user, "end": end})
+            self.end_num += int(bool(end)) - int(bool(node.end))
+            node.extend(assistant=assistant, user=user, end=end)
+
+    def _attach(self, node: Node, children: list[Node]):
+        self._log({"op": "expand", "path": node.path(), "children": [
+            {"strategy": c.strategy, "score": c.strategy_score} | ({"assistant": c.assistant, "user": c.user, "end": c.end} if c.is_extend else {})
+            for c in children
+        ]})
+        self.end_num += sum(bool(c.end) for c in children)
+        node.children.extend(children)
+
+    def _backward(self, node: Node, reward):
+        self._log({"op": "backward", "path": node.path(), "reward": reward})
+        node.backward(reward)
 
     def select(self):
-        node = self.tree
-        while not len(node.children) == 0:
-            node = max(node.children, key=lambda child: child.PUCB)
+        node = self.tree.select()
         if not node.is_extend:
             self.extend_node(node)
         return node
     
-    def expand(self, node: Node):
+    def _gen_child(self, node: Node, history, score):
+        child = self._new_node(node, score['strategy'], score['score'])
+        step, rest = self._take_rollout(node, score['strategy']) if FORCE_EXTEND else (None, None)
+        if step is not None:
+            child.rollout = rest
+            child.extend(assistant=step['assistant'], user=step['user'], end=step['end'])
+        elif FORCE_EXTEND:
+            assistant = self.gen_assistant_fn(history, score['strategy'])
+            user, end = self.gen_user_fn(history + [{"role": "supporter", "content": assistant, "strategy": score['strategy']}])
+            child.extend(assistant=assistant, user=user, end=end)
+        return child
+
+    def _expand_children(self, node: Node):
         history = node.build_history()
-        score_list = self.gen_strategy_fn(history)
-        for score in score_list:
-            if FORCE_EXTEND:
-                assistant, res_score, bad_list = self.gen_assistant_fn(history, score['strategy'])
-                user, end = self.gen_user_fn(history + [{"role": "supporter", "content": assistant, "strategy": score['strategy']}])
-                end = end
-                child = Node(parent=node, strategy=score['strategy'], strategy_score=score['score'], c=self.c)
-                child.extend(assistant=assistant, user=user, end=end)
-            else:
-                child = Node(parent=node, strategy=score['strategy'], strategy_score=score['score'], c=self.c)
-            node.children.append(child)
-        self.draw()
+        chain = node.rollout if self.reuse_rollouts else None
+        score_list = [dict(s) for s in chain[0]['scores']] if chain else self.gen_strategy_fn(history)
+        if FORCE_EXTEND and EXTEND_WORKERS > 1:
+            # children keep the order of score_list whichever chain finishes first
+            with ThreadPoolExecutor(max_workers=min(EXTEND_WORKERS, len(score_list))) as executor:
+                children = list(executor.map(metrics.in_context(functools.partial(self._gen_child, node, history)), score_list))
+        else:
+            children = [self._gen_child(node, history, score) for score in score_list]
+        return children
+
+    def expand(self, node: Node):
+        self._attach(node, self._expand_children(node))
 
     def _sim(self, node: Node):
         history = node.build_history()
+        chain = []
+        # the rest of a rollout that reached node from its parent is replayed, only the turns after it are generated
+        cached = (node.rollout or []) if self.reuse_rollouts else []
 
         for i in range(1000 if self.sim_max_round == 'end' else self.sim_max_round):
-            score_list = self.gen_strategy_fn(history)
-            score = max(score_list, key=lambda x: x['score'])
+            step = cached[i] if i < len(cached) else None
+            if step is not None and step['strategy'] == max(step['scores'], key=lambda x: x['score'])['strategy']:
+                history.append({"role": "supporter", "content": step['assistant'], "strategy": step['strategy']})
+                history.append({"role": "user", "content": step['user']})
+                chain.append(step)
+                end = step['end']
+            else:
+                cached = []
+                score_list = self.gen_strategy_fn(history)
+                score = max(score_list, key=lambda x: x['score'])
 
-            assistant = self.gen_assistant_fn(history, score['strategy'])
-            history.append({"role": "supporter", "content": assistant, "strategy": score['strategy']})
-            user, end = self.gen_user_fn(history)
-            history.append({"role": "user", "content": user})
+                assistant = self.gen_assistant_fn(history, score['strategy'])
+                history.append({"role": "supporter", "content": assistant, "strategy": score['strategy']})
+                user, end = self.gen_user_fn(history)
+                history.append({"role": "user", "content": user})
+                chain.append({"scores": [dict(s) for s in score_list], "strategy": score['strategy'], "assistant": assistant, "user": user, "end": end})
             if end:
                 break
+        if self.reuse_rollouts:
+            node.rollout = chain
         return history, i + 1, end
     
     def simulate_and_backpropagate(self, node: Node):
@@ -160,23 +655,138 @@ class MCTS:
             self.extend_node(child)
         if child.end:
             sim_history = child.build_history()
-            child.backward(self._reward(sim_history, 0))
+            self._backward(child, self._reward(sim_history, 0))
             return
         sim_history, sim_round, end = self._sim(child)
-        child.backward(self._reward(sim_history, sim_round))
+        self._backward(child, self._reward(sim_history, sim_round))
 
-    def update(self):
-        selected = self.select()
+    def update(self, selected=None):
+        if selected is None:
+            selected = self.select()
         if not selected.end:
             self.expand(selected)
             self.simulate_and_backpropagate(selected)
-            self.draw()
         else:
             sim_history = selected.build_history()
-            selected.backward(self._reward(sim_history, 0))
-            self.draw()
+            self._backward(selected, self._reward(sim_history, 0))
+
+    def _claim(self):
+        # walk down by PUCB and hold the leaf, virtual loss on the path steers other workers elsewhere
+        with self._cond:
+            while True:
+                node = self.tree.select()
+                if not node.pending:
+                    break
+                self._cond.wait()
+            node.pending = True
+            node.add_virtual_loss(1)
+            return node
+
+    def _extend_shared(self, node: Node):
+        assistant, user, end = self._gen_turn(node)
+        with self._cond:
+            self._extend(node, assistant, user, end)
+
+    def _release(self, selected: Node, sim_node: Node):
+        if sim_node is not selected:
+            sim_node.virtual_loss = 0
+            sim_node._update_PUCB()
+        selected.add_virtual_loss(-1)
+        selected.pending = sim_node.pending = False
+
+    def update_parallel(self):
+        selected = self._claim()
+        sim_node = selected
+        try:
+            if not selected.is_extend:
+                self._extend_shared(selected)
+            if selected.end:
+                reward = self._reward(selected.build_history(), 0)
+            else:
+                children = self._expand_children(selected)
+                sim_node = max(children, key=lambda child: child.strategy_score)
+                sim_node.pending = True
+                sim_node.virtual_loss = 1
+                with self._cond:
+                    self._attach(selected, children)
+                    for child in children:
+                        child._update_PUCB()
+                    self._cond.notify_all()
+                if not sim_node.is_extend:
+                    self._extend_shared(sim_node)
+                if sim_node.end:
+                    reward = self._reward(sim_node.build_history(), 0)
+                else:
+                    sim_history, sim_round, end = self._sim(sim_node)
+                    reward = self._reward(sim_history, sim_round)
+        except BaseException:
+            with self._cond:
+                self._release(selected, sim_node)
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._release(selected, sim_node)
+            self._backward(sim_node, reward)
+            self._cond.notify_all()
+
+    def _run_parallel(self, tree_tmp_path):
+        bar = trange(self.iter, self.max_iter, initial=self.iter, total=self.max_iter)
+        self._started = self.iter
+
+        def worker():
+            while True:
+                with self._cond:
+                    end_num = self.end_num
+                    if self.stop_reason is not None:
+                        return
+                    if self._started >= self.max_iter:
+                        self.stop_reason = 'max_iter'
+                        return
+                    if self._started >= self.min_iter and end_num >= self.min_end:
+                        print('min end and min iter reached, ', f'{self._started=}, {end_num=}')
+                        self.stop_reason = 'min_iter_and_end'
+                        return
+                    if end_num >= self.max_end:
+                        print('max end reached, ', f'{self._started=}, {end_num=}')
+                        self.stop_reason = 'max_end'
+                        return
+                    self._started += 1
+                try:
+                    self.update_parallel()
+                except BaseException:
+                    # the other workers return at their next check instead of spending the rest of the budget
+                    with self._cond:
+                        self.stop_reason = 'error'
+                        self._cond.notify_all()
+                    raise
+                with self._cond:
+                    self.iter += 1
+                    bar.update()
+                    self._checkpoint(tree_tmp_path)
+                    self._maybe_draw()
+                    if self.stop_reason is None and self._converged():
+                        print('converged, ', f'{self.iter=}, {self.end_num=}')
+                        self.stop_reason = 'converged'
 
-    def run(self, description, scene, min_iter, min_end, max_iter, max_end, tmp_path, json_data=None):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(metrics.in_context(worker)) for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+        bar.close()
+
+    def run(self, description, scene, min_iter, min_end, max_iter, max_end, tmp_path, json_data=None, metrics_path=None):
+        # LLM calls of this tree are also counted in self.metrics, written to metrics_path (.json or .prom) at the end
+        self.metrics = Metrics()
+        try:
+            with metrics.scope(self.metrics):
+                self._run(description, scene, min_iter, min_end, max_iter, max_end, tmp_path, json_data)
+        finally:
+            if metrics_path is not None:
+                self.metrics.export(metrics_path)
+
+    def _run(self, description, scene, min_iter, min_end, max_iter, max_end, tmp_path, json_data=None):
+        self.stop_reason = None
+        self._reference, self._stable = None, 0
         self.min_iter = min_iter
         self.min_end = min_end
         self.max_iter = max_iter
@@ -192,41 +802,134 @@ class MCTS:
             self.scene = json_data['scene']
             self.iter = 0
             self.build_from_json(json_data)
-            self.draw()
+            self._maybe_draw()
         else:
             self.description = description
             self.scene = scene
             self.iter = 0
             user, end = self.gen_user_fn([{"role": "supporter", "content": self.init_assistant}])
-            self.tree = Node(parent=None, strategy="start", strategy_score=1, c=self.c)
+            self.tree = self._new_node(None, "start", 1)
             self.tree.extend(assistant=self.init_assistant, user=user, end=end)
+        self.end_num = self.tree.count_end()
+
+        if self.checkpoint == 'journal':
+            # restart the journal from the loaded state, dropping any events of an unfinished iteration
+            self._snapshot(tree_tmp_path)
+            self._journal = open(self._journal_path(tree_tmp_path), 'a', encoding='utf-8')
+        elif os.path.exists(self._journal_path(tree_tmp_path)):
+            self.save(tree_tmp_path)
+            os.remove(self._journal_path(tree_tmp_path))
+        try:
+            self._loop(tree_tmp_path)
+        except BaseException:
+            # the serial loop and a failed _run_parallel worker alike
+            self.stop_reason = 'error'
+            raise
+        finally:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _loop(self, tree_tmp_path):
+        min_iter, min_end, max_iter, max_end = self.min_iter, self.min_end, self.max_iter, self.max_end
+        if self.workers > 1:
+            self._run_parallel(tree_tmp_path)
+            return
 
         start_i = self.iter
         # print(start_i)
         for i in trange(start_i, max_iter, initial=start_i, total=max_iter):
-            end_num = self.tree.count_end()
-            sel_end = self.select().end
+            end_num = self.end_num
+            # the leaf picked here is the one update() works on, so each iteration selects once
+            selected = self.select()
+            sel_end = selected.end
             if self.iter >= min_iter:
                 print('min iter reached, ', f'{self.iter=}, {min_iter=}')
             if end_num >= min_end:
                 print('min end reached, ', f'{end_num=}, {min_end=}')
             if not sel_end and self.iter >= min_iter and end_num >= min_end:
                 print('min end and min iter reached, ', f'{self.iter=}, {end_num=}')
+                self.stop_reason = 'min_iter_and_end'
                 return
             if not sel_end and end_num >= max_end:
                 print('max end reached, ', f'{self.iter=}, {end_num=}')
+                self.stop_reason = 'max_end'
                 return
-            self.update()
+            self.update(selected)
             print(f'\n{"-"*40}\niter {i}: {time.asctime()}\n{"-"*40}\n')
             self.iter = i + 1
-            self.save(tree_tmp_path)
+            self._checkpoint(tree_tmp_path)
+            self._maybe_draw()
+            if self._converged():
+                print('converged, ', f'{self.iter=}, {self.end_num=}')
+                self.stop_reason = 'converged'
+                return
         print('max iter reached')
+        self.stop_reason = 'max_iter'
 
+    def best_path(self):
+        # root to leaf by best Q, the path get_best_json returns
+        path = [self.tree]
+        while len(path[-1].children) != 0:
+            path.append(max(path[-1].children, key=lambda child: child.Q))
+        return path
 
-    def draw(self, save_path=None, format='png'):
-        if save_path == None:
-            save_path = self.tmp_path
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    def _real_stats(self, node):
+        # (N, Q) of the backpropagated rewards alone, without what build_from_json seeded the node with
+        seed = getattr(node, 'seed', None)
+        if not seed:
+            return node.N, node.Q
+        n = node.N - seed[0]
+        return n, (node.Q * node.N - seed[1] * seed[0]) / n if n > 0 else 0.0
+
+    def _path_stats(self, path):
+        # per level of path, down to the first parent with fewer than converge_min_visits real visits:
+        # (share of those visits, real Q / reward_range) of the node on the path
+        stats = []
+        for parent, node in zip(path, path[1:]):
+            total = sum(self._real_stats(child)[0] for child in parent.children)
+            if total < self.converge_min_visits:
+                break
+            n, q = self._real_stats(node)
+            stats.append((n / total, q / self.reward_range))
+        return stats
+
+    def _converged(self):
+        if not self.converge_patience:
+            return False
+        # stable while the nodes of the reference path keep their visit share and Q, whichever near-tied sibling the
+        # best path goes through further down; a new best child of the root or a drift beyond converge_tol restarts it
+        path = self.best_path()
+        if self._reference is not None and len(self._reference[0]) > 1 and self._reference[0][1] == path[1] and all(
+                abs(share - ref_share) <= self.converge_tol and abs(q - ref_q) <= self.converge_tol
+                for (share, q), (ref_share, ref_q) in zip(self._path_stats(self._reference[0]), self._reference[1])):
+            self._stable += 1
+        else:
+            stats = self._path_stats(path)
+            self._reference, self._stable = (path[:len(stats) + 1], stats), 0
+        if self._stable < self.converge_patience or self.iter < self.converge_min_iter or self.end_num < self.min_end:
+            return False
+        return self._separated()
+
+    def _separated(self):
+        # the root child on the best path is the most visited one and its lower bound clears the upper bound of every
+        # sibling with converge_min_visits visits
+        if not self.tree.children:
+            return False
+        best = self.best_path()[1]
+        n_best, q_best = self._real_stats(best)
+        others = [self._real_stats(child) for child in self.tree.children if child != best]
+        if n_best < self.converge_min_visits or any(n > n_best for n, _ in others):
+            return False
+        bound = lambda n: self.reward_range * math.sqrt(math.log(2 / self.converge_delta) / (2 * n))
+        return all(q_best - bound(n_best) > q + bound(n) for n, q in others if n >= self.converge_min_visits)
+
+
+    def _maybe_draw(self):
+        if self.render == 'every' and self.iter % self.render_every == 0:
+            self.draw(background=True)
+
+    def to_dot(self):
         color_map = {
             "Emotional Validation": "#A1A9D0",
             "Affirmation": "#F0988C",
@@ -244,18 +947,133 @@ class MCTS:
                 graph.edge(node.id, child.id)
                 add_nodes_edges(graph, child)
         dot = Digraph(comment='Tree Visualization')
-        dot.node(self.tree.id, label=self.tree.label, style='filled', fillcolor=color_map[self.tree.strategy])
-        add_nodes_edges(dot, self.tree)
-        dot.render(save_path, format=format, view=False)
+        with self._cond:
+            dot.node(self.tree.id, label=self.tree.label, style='filled', fillcolor=color_map[self.tree.strategy])
+            add_nodes_edges(dot, self.tree)
+        return dot
+
+    def to_json(self):
+        def node_dict(node: Node):
+            return {"strategy": node.strategy, "score": node.strategy_score, "N": node.N, "Q": node.Q, "PUCB": node.PUCB, "end": node.end, "is_extend": node.is_extend, "children": [node_dict(c) for c in node.children]}
+        with self._cond:
+            return node_dict(self.tree)
+
+    def draw(self, save_path=None, format='png', background=False):
+        if save_path == None:
+            save_path = self.tmp_path
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        dot = self.to_dot()
+        if not background:
+            dot.render(save_path, format=format, view=False)
+            return
+        # a picture still rendering is not queued again, the next draw catches up
+        if save_path in self._renders and not self._renders[save_path].done():
+            return
+        self._renders[save_path] = render_pool().submit(_render, dot.source, save_path, format)
+
+    def export(self, path, format: Literal['dot', 'json']='dot'):
+        # structure only, without running graphviz
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            if format == 'dot':
+                f.write(self.to_dot().source)
+            else:
+                json.dump(self.to_json(), f, ensure_ascii=False)
 
     def save(self, path):
-        save_dict = {"c": self.c, "sim_max_round": self.sim_max_round, "description": self.description, "scene": self.scene, "iter": self.iter, "tree": self.tree}
+        if path.endswith(treefile.EXT):
+            tree = self.tree if isinstance(self.tree, NodeView) else TreeStore.from_node(self.tree)
+            meta = {"sim_max_round": self.sim_max_round, "description": self.description, "scene": self.scene, "iter": self.iter, "seq": self._seq, "stop_reason": self.stop_reason}
+            treefile.write(path, meta, tree.store)
+            return
+        save_dict = {"c": self.c, "sim_max_round": self.sim_max_round, "description": self.description, "scene": self.scene, "iter": self.iter, "tree": self.tree, "seq": self._seq, "stop_reason": self.stop_reason}
 
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, 'wb') as f:
+        # write then rename, so a crash mid-write leaves the previous checkpoint intact
+        with open(f'{path}.tmp', 'wb') as f:
             pickle.dump(save_dict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{path}.tmp', path)
+
+    @staticmethod
+    def _journal_path(path):
+        return f'{os.path.splitext(path)[0]}.journal'
+
+    def _log(self, event):
+        if self._journal is None:
+            return
+        with self._cond:
+            self._seq += 1
+            event["seq"] = self._seq
+            self._journal.write(json.dumps(event, ensure_ascii=False) + '\n')
+
+    def _checkpoint(self, path):
+        if self.checkpoint != 'journal':
+            self.save(path)
+            return
+        with self._cond:
+            self._journal.write(json.dumps({"op": "iter", "iter": self.iter}) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            if self.iter % self.snapshot_every == 0:
+                self._snapshot(path)
+
+    def _snapshot(self, path):
+        # events up to self._seq are in the snapshot, so the journal can start over
+        self.save(path)
+        if self._journal is not None:
+            self._journal.close()
+        with open(f'{self._journal_path(path)}.tmp', 'w', encoding='utf-8') as f:
+            pass
+        os.replace(f'{self._journal_path(path)}.tmp', self._journal_path(path))
+        if self._journal is not None:
+            self._journal = open(self._journal_path(path), 'a', encoding='utf-8')
+
+    def _replay(self, path):
+        # only events followed by an iter marker are applied, a torn or unfinished iteration is dropped
+        pending = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if event["op"] != "iter":
+                    pending.append(event)
+                    continue
+                for e in pending:
+                    if e["seq"] > self._seq:
+                        self._apply(e)
+                        self._seq = e["seq"]
+                pending = []
+                self.iter = max(self.iter, event["iter"])
+
+    def _apply(self, event):
+        node = self.tree
+        for i in event["path"]:
+            node = node.children[i]
+        if event["op"] == "extend":
+            node.extend(assistant=event["assistant"], user=event["user"], end=event["end"])
+        elif event["op"] == "expand":
+            for c in event["children"]:
+                child = self._new_node(node, c["strategy"], c["score"])
+                if "assistant" in c:
+                    child.extend(assistant=c["assistant"], user=c["user"], end=c["end"])
+                node.children.append(child)
+        elif event["op"] == "backward":
+            node.backward(event["reward"])
 
     def load(path):
+        if treefile.is_tree_file(path):
+            tree = treefile.TreeFile(path)
+            mcts = MCTS(None, c=tree.header['c'], sim_max_round=tree.meta['sim_max_round'], tree_store='array')
+            mcts.tree = TreeStore.from_file(tree)
+            mcts.description = tree.meta['description']
+            mcts.scene = tree.meta['scene']
+            mcts.iter = tree.meta['iter']
+            mcts.stop_reason = tree.meta.get('stop_reason')
+            return mcts
         with open(path, 'rb') as f:
             save_dict = pickle.load(f)
             mcts = MCTS(None, c=save_dict['c'], sim_max_round=save_dict['sim_max_round'])
@@ -263,6 +1081,7 @@ class MCTS:
             mcts.description = save_dict['description']
             mcts.scene = save_dict['scene']
             mcts.iter = save_dict['iter']
+            mcts.stop_reason = save_dict.get('stop_reason')
             return mcts
         
     def load_tmp(self, path):
@@ -272,26 +1091,28 @@ class MCTS:
         self.description = save_dict['description']
         self.scene = save_dict['scene']
         self.iter = save_dict['iter']
+        self._seq = save_dict.get('seq', 0)
+        if os.path.exists(self._journal_path(path)):
+            self._replay(self._journal_path(path))
         
     def get_best_json(self):
         # best Q
-        node = self.tree
-        while not len(node.children) == 0:
-            node = max(node.children, key=lambda child: child.Q)
-        return node.build_history()
+        return self.best_path()[-1].build_history()
     
     def build_from_json(self, json_data):
         if json_data['messages'][0]['role'] == 'user':
-            self.tree = Node(parent=None, strategy="start", strategy_score=1, c=self.c)
+            self.tree = self._new_node(None, "start", 1)
             self.tree.extend(assistant=self.init_assistant, user=json_data['messages'][0]['content'], end=False)
             self.tree.Q = 4 + self.rw_bias
             self.tree.N = 100
+            self.tree.seed = (self.tree.N, self.tree.Q)
             json_data['messages'].pop(0)
         else:
-            self.tree = Node(parent=None, strategy=json_data['messages'][0]['strategy'], strategy_score=1, c=self.c)
+            self.tree = self._new_node(None, json_data['messages'][0]['strategy'], 1)
             self.tree.extend(assistant=json_data['messages'][0]['content'], user=json_data['messages'][1]['content'], end=False)
             self.tree.Q = 4 + self.rw_bias
             self.tree.N = 100
+            self.tree.seed = (self.tree.N, self.tree.Q)
             json_data['messages'].pop(0)
             json_data['messages'].pop(0)
         node = self.tree
@@ -303,16 +1124,17 @@ class MCTS:
                 scores.append({'strategy': json_data['messages'][i]['strategy'], 'score': 0.1})
             for s in scores:
                 if s['strategy'] == json_data['messages'][i]['strategy']:
-                    new_node = Node(parent=node, strategy=s['strategy'], strategy_score=s['score'], c=self.c)
+                    new_node = self._new_node(node, s['strategy'], s['score'])
                     if len(json_data['messages']) > i+1:
                         new_node.extend(assistant=json_data['messages'][i]['content'], user=json_data['messages'][i+1]['content'], end=False)
                     else:
                         new_node.extend(assistant=json_data['messages'][i]['content'], user=None, end=False)
                     new_node.Q = 4 + self.rw_bias
                     new_node.N = 100
+                    new_node.seed = (new_node.N, new_node.Q)
                     node.children.append(new_node._update_PUCB())
                 else:
-                    node.children.append(Node(parent=node, strategy=s['strategy'], strategy_score=s['score'], c=self.c)._update_PUCB())
+                    node.children.append(self._new_node(node, s['strategy'], s['score'])._update_PUCB())
             node = new_node
         new_node.end = True
 
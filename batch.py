@@ -0,0 +1,254 @@
+import os
+import glob
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# OpenAI batch statuses after which nothing changes any more
+DONE = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchError(Exception):
+    # one request of a batch came back without a completion, retry() treats it like the same API error
+    def __init__(self, custom_id, status_code, message) -> None:
+        super().__init__(f'{custom_id}: {status_code} {message}')
+        self.status_code = status_code
+
+
+class BatchTimeout(BatchError):
+    # the batch did not finish within max_age, retry() raises it instead of sending the request again
+    pass
+
+
+class OpenAITransport:
+    # uploads the JSONL file and runs it through the Batch API (24h window, discounted)
+    def __init__(self, client=None, completion_window='24h') -> None:
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv('openai_key'), base_url=os.getenv('openai_url'))
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, path):
+        with open(path, 'rb') as f:
+            file = self.client.files.create(file=f, purpose='batch')
+        return self.client.batches.create(input_file_id=file.id, endpoint='/v1/chat/completions', completion_window=self.completion_window).id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in self.client.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+class LocalTransport:
+    # file-based stand-in: a background thread answers every line with `complete(body) -> response body`
+    # (by default the regular chat completions endpoint) and writes <input>.output.jsonl when it is done
+    def __init__(self, complete=None, workers=8) -> None:
+        if complete is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=os.getenv('openai_key'), base_url=os.getenv('openai_url'), max_retries=0)
+            complete = lambda body: client.chat.completions.create(**body).model_dump()
+        self.complete = complete
+        self.workers = workers
+        self._running = set()
+
+    def submit(self, path):
+        self._running.add(path)
+        threading.Thread(target=self._process, args=(path,), daemon=True).start()
+        return path
+
+    def _answer(self, line):
+        request = json.loads(line)
+        try:
+            return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": self.complete(request["body"])}, "error": None}
+        except Exception as e:
+            return {"custom_id": request["custom_id"], "response": {"status_code": getattr(e, 'status_code', 500), "body": None}, "error": {"message": str(e)}}
+
+    def _process(self, path):
+        with open(path, encoding='utf-8') as f:
+            lines = [line for line in f if line.strip()]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._answer, lines))
+        with open(f'{path}.output.tmp', 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+        os.replace(f'{path}.output.tmp', f'{path}.output.jsonl')
+        self._running.discard(path)
+
+    def status(self, batch_id):
+        if os.path.exists(f'{batch_id}.output.jsonl'):
+            return 'completed'
+        # a file submitted by an earlier process will never be answered
+        return 'in_progress' if batch_id in self._running else 'expired'
+
+    def results(self, batch_id):
+        with open(f'{batch_id}.output.jsonl', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+class BatchCollector:
+    # process-wide queue of chat requests: a batch goes out when it has max_requests lines or its oldest
+    # request waited max_wait seconds, and every caller blocks on its own future until the batch is back.
+    # With a cache, every submitted batch leaves <batch file>.manifest.json (batch id and the cache key of each
+    # custom_id) until its answers are stored, and a new collector first collects what an earlier process left;
+    # requests queued meanwhile wait for that and are answered from the cache when a recovered batch had them.
+    # A batch not done max_age seconds after it was submitted fails its requests with BatchTimeout
+    def __init__(self, transport, root='output/batch', model=None, max_requests=1000, max_wait=30, poll=60, cache=None, max_age=26 * 3600) -> None:
+        self.transport = transport
+        self.root = root
+        self.model = model
+        self.max_requests = max_requests
+        self.max_wait = max_wait
+        self.poll = poll
+        self.cache = cache
+        self.max_age = max_age
+        self._pending: list[tuple[dict, str, Future]] = []
+        self._first = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._recovered: set[str] = set()
+        threading.Thread(target=self._start, name='batch-collector', daemon=True).start()
+
+    def _start(self):
+        if self.cache is not None:
+            try:
+                self.recover()
+            except Exception as e:
+                print(f'batch recovery failed: {e!r}')
+        self._collect()
+
+    def submit(self, messages, params, key=None) -> Future:
+        # key: ResponseCache key the answer is stored under once the batch is back
+        future = Future()
+        with self._cond:
+            if not self._pending:
+                self._first = time.monotonic()
+            self._pending.append(({"model": self.model, "messages": messages, **params}, key, future))
+            self._cond.notify()
+        return future
+
+    def recover(self):
+        # waits until every batch in a leftover manifest is done (or older than max_age) and its answers are in the cache
+        for manifest in sorted(glob.glob(os.path.join(self.root, '*.manifest.json'))):
+            with open(manifest, encoding='utf-8') as f:
+                info = json.load(f)
+            print(f'batch {info["batch_id"]}: collecting {len(info["keys"])} requests of an earlier run')
+            status = self._wait(info["batch_id"], info.get("submitted", os.path.getmtime(manifest)))
+            stored = 0
+            if status == 'completed':
+                for result in self.transport.results(info["batch_id"]):
+                    key = info["keys"].get(result["custom_id"])
+                    response = result.get("response") or {}
+                    if key and response.get("status_code") == 200 and response.get("body"):
+                        self.cache.put(key, response["body"]["choices"][0]["message"]["content"])
+                        self._recovered.add(key)
+                        stored += 1
+            print(f'batch {info["batch_id"]}: {stored} answers cached ({status})')
+            os.remove(manifest)
+
+    def _wait(self, batch_id, submitted):
+        # final status, or the last one seen once the batch is max_age old (an unknown status is polled like a running one)
+        while (status := self.transport.status(batch_id)) not in DONE:
+            if time.time() - submitted > self.max_age:
+                break
+            time.sleep(self.poll)
+        return status
+
+    def _write_manifest(self, path, batch_id, keys, submitted):
+        with open(f'{path}.manifest.tmp', 'w', encoding='utf-8') as f:
+            json.dump({"batch_id": batch_id, "model": self.model, "submitted": submitted, "keys": keys}, f)
+        os.replace(f'{path}.manifest.tmp', f'{path}.manifest.json')
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._pending or (len(self._pending) < self.max_requests and time.monotonic() - self._first < self.max_wait):
+                    self._cond.wait(None if not self._pending else self.max_wait - (time.monotonic() - self._first))
+                requests, self._pending = self._pending[:self.max_requests], self._pending[self.max_requests:]
+                self._first = time.monotonic()
+                self._seq += 1
+                seq = self._seq
+            # batches are polled side by side, the collector goes straight back to filling the next one
+            threading.Thread(target=self._run, args=(seq, requests), daemon=True).start()
+
+    def _run(self, seq, requests):
+        if self._recovered:
+            # queued while recovery ran, the answer may already be in the cache
+            waiting = []
+            for body, key, future in requests:
+                output = self.cache.get(key) if key in self._recovered else None
+                if output is None:
+                    waiting.append((body, key, future))
+                else:
+                    future.set_result({"choices": [{"message": {"role": 'assistant', "content": output}}]})
+            requests = waiting
+            if not requests:
+                return
+        futures = {f'{seq}-{i}': future for i, (_, _, future) in enumerate(requests)}
+        keys = {custom_id: key for custom_id, (_, key, _) in zip(futures, requests) if key}
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            path = os.path.join(self.root, f'{time.strftime("%Y%m%d-%H%M%S")}-{seq}.jsonl')
+            with open(path, 'w', encoding='utf-8') as f:
+                for custom_id, (body, _, _) in zip(futures, requests):
+                    f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False) + '\n')
+            batch_id = self.transport.submit(path)
+            submitted = time.time()
+            print(f'batch {batch_id}: {len(requests)} requests')
+            if self.cache is not None and keys:
+                self._write_manifest(path, batch_id, keys, submitted)
+            status = self._wait(batch_id, submitted)
+            if status not in DONE:
+                if os.path.exists(f'{path}.manifest.json'):
+                    os.remove(f'{path}.manifest.json')
+                raise BatchTimeout(batch_id, None, f'still {status} after {self.max_age:.0f}s')
+            results = [result for result in self.transport.results(batch_id) if result["custom_id"] in futures]
+            # answers are cached and the manifest dropped before any caller wakes up
+            if self.cache is not None and keys:
+                for result in results:
+                    response = result.get("response") or {}
+                    if result["custom_id"] in keys and response.get("status_code") == 200 and response.get("body"):
+                        self.cache.put(keys[result["custom_id"]], response["body"]["choices"][0]["message"]["content"])
+                os.remove(f'{path}.manifest.json')
+            for result in results:
+                future = futures.pop(result["custom_id"], None)
+                if future is None:
+                    continue
+                response = result.get("response") or {}
+                if response.get("status_code") == 200 and response.get("body"):
+                    future.set_result(response["body"])
+                else:
+                    future.set_exception(BatchError(result["custom_id"], response.get("status_code"), (result.get("error") or {}).get("message")))
+            for custom_id, future in futures.items():
+                future.set_exception(BatchError(custom_id, None, f'missing from batch {batch_id} ({status})'))
+        except BaseException as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+
+def from_env(model, cache=None):
+    # batch_transport: 'openai' or 'local', batch_dir: where batch files and manifests are kept,
+    # batch_size / batch_wait: flush after this many requests or seconds, batch_poll: seconds between status checks,
+    # batch_max_age: seconds after which an unfinished batch is given up
+    transport = LocalTransport() if os.getenv('batch_transport', 'openai') == 'local' else OpenAITransport()
+    return BatchCollector(
+        transport,
+        root=os.getenv('batch_dir', 'output/batch'),
+        model=model,
+        max_requests=int(os.getenv('batch_size', 1000)),
+        max_wait=float(os.getenv('batch_wait', 30)),
+        poll=float(os.getenv('batch_poll', 60)),
+        cache=cache,
+        max_age=float(os.getenv('batch_max_age', 26 * 3600)),
+    )
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_llm import MockLLM, STRATEGIES
+
+
+DESCRIPTION = 'I failed my driving test for the third time and my parents keep comparing me to my brother.'
+SCENE = 'frustration'
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def new_mcts(**kwargs):
+    import run
+    from MCTS import MCTS
+    return MCTS(
+        init_assistant=run.SUPPORTER_START,
+        c=run.C,
+        sim_max_round=4,
+        gen_strategy_fn=run.gen_strategy,
+        gen_assistant_fn=run.gen_assistant,
+        gen_user_fn=run.gen_user,
+        eval_all_fn=run.eval_all,
+        rw_bias=run.RW_BIAS,
+        render='never',
+        **kwargs,
+    )
+
+
+def bench_tree(iterations, quiet=True, **kwargs):
+    # one tree for a fixed number of iterations against the mock server;
+    # redirect_stdout swaps the process-wide sys.stdout, so threaded callers pass quiet=False and redirect once around the pool
+    mcts = new_mcts(**kwargs)
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+        _, seconds = timed(mcts.run, DESCRIPTION, SCENE, min_iter=iterations, min_end=10**9, max_iter=iterations, max_end=10**9, tmp_path=f'{tmp}/tree')
+    return {"iterations": mcts.iter, "nodes": count_nodes(mcts.tree), "seconds": seconds, "iter_per_sec": mcts.iter / seconds}
+
+
+def bench_trees(threads, trees, iterations):
+    with ThreadPoolExecutor(max_workers=threads) as executor, contextlib.redirect_stdout(io.StringIO()):
+        _, seconds = timed(lambda: list(executor.map(lambda _: bench_tree(iterations, quiet=False), range(trees))))
+    return {"threads": threads, "trees": trees, "seconds": seconds, "trees_per_hour": trees / seconds * 3600}
+
+
+def count_nodes(root):
+    num = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        num += 1
+        stack.extend(node.children)
+    return num
+
+
+def synthetic_tree(n_nodes, seed=0, tree_store='node'):
+    # random MCTS-shaped tree: a random open leaf is expanded into all strategies, about half of them extended
+    from MCTS import MCTS
+    rng = random.Random(seed)
+    mcts = MCTS(c=1, render='never', tree_store=tree_store)
+    mcts.description, mcts.scene, mcts.iter = DESCRIPTION, SCENE, 0
+    mcts.tree = mcts._new_node(None, 'start', 1)
+    mcts.tree.extend(assistant='Hello, how can I support you today?', user='I feel awful.', end=False)
+    frontier = [mcts.tree]
+    num = 1
+    while num < n_nodes and frontier:
+        i = rng.randrange(len(frontier))
+        frontier[i], frontier[-1] = frontier[-1], frontier[i]
+        node = frontier.pop()
+        children = [mcts._new_node(node, s, 1 / len(STRATEGIES)) for s in STRATEGIES]
+        node.children.extend(children)
+        num += len(children)
+        for child in children:
+            if rng.random() < 0.5:
+                child.extend(assistant=f'supporter turn {num} {child.strategy}', user=f'seeker turn {num}', end=rng.random() < 0.1)
+                child.N = rng.randint(0, 20)
+                child.Q = rng.uniform(-3, 1)
+                if not child.end:
+                    frontier.append(child)
+    return mcts
+
+
+def bench_io(n_nodes, tree_store='node'):
+    mcts = synthetic_tree(n_nodes, tree_store=tree_store)
+    result = {"nodes": count_nodes(mcts.tree), "tree_store": tree_store}
+    with tempfile.TemporaryDirectory() as tmp:
+        _, result["save_s"] = timed(mcts.save, f'{tmp}/tree.pkl')
+        result["pickle_mb"] = os.path.getsize(f'{tmp}/tree.pkl') / 2**20
+        _, result["load_s"] = timed(type(mcts).load, f'{tmp}/tree.pkl')
+        _, result["dot_s"] = timed(mcts.export, f'{tmp}/tree.dot', 'dot')
+        _, result["json_s"] = timed(mcts.export, f'{tmp}/tree.json', 'json')
+        if shutil.which('dot') and n_nodes <= 10000:
+            _, result["draw_s"] = timed(mcts.draw, f'{tmp}/pic/tree')
+    return result
+
+
+def bench_data(n_nodes):
+    import build_data
+    import change_data
+    import change_data_kto
+    mcts = synthetic_tree(n_nodes)
+    result = {"nodes": count_nodes(mcts.tree)}
+    with contextlib.redirect_stdout(io.StringIO()):
+        paths, result["build_path_s"] = timed(build_data.build_path, mcts)
+        historys, result["build_compare_s"] = timed(build_data.build_compare, mcts)
+        records = [{"description": mcts.description, "scene": mcts.scene, "iter": mcts.iter, "messages": h} for h in historys]
+        pairs, result["change_data_s"] = timed(change_data.convert, records)
+        kto, result["change_data_kto_s"] = timed(change_data_kto.convert, records)
+    result.update({"paths": len(paths), "records": len(records), "pairs": len(pairs), "kto": len(kto)})
+    return result
+
+
+def report(name, result):
+    print(name, ' '.join(f'{k}={v:.4g}' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()), flush=True)
+    return {"bench": name} | result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', nargs='+', default=['tree', 'trees', 'io', 'data'], choices=['tree', 'trees', 'io', 'data'])
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds per mock LLM call')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--trees', type=int, default=16)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--out', default=None, help='write all results to this JSON file')
+    args = parser.parse_args()
+
+    server = MockLLM(latency=args.latency, error_rate=args.error_rate).start()
+    # the mock must not be shadowed by a user's .env, and its replies must not land in a real cache
+    os.environ.update({'openai_url': server.url, 'openai_key': 'mock', 'llm_cache': '', 'openai_rpm': '0', 'openai_tpm': '0'})
+
+    results = []
+    if 'tree' in args.suite:
+        for workers in args.workers:
+            for tree_store in ('node', 'array'):
+                results.append(report('tree', {"workers": workers} | bench_tree(args.iterations, workers=workers, tree_store=tree_store) | {"tree_store": tree_store}))
+    if 'trees' in args.suite:
+        for threads in args.threads:
+            results.append(report('trees', bench_trees(threads, args.trees, args.iterations)))
+    if 'io' in args.suite:
+        for n in args.sizes:
+            for tree_store in ('node', 'array'):
+                results.append(report('io', bench_io(n, tree_store)))
+    if 'data' in args.suite:
+        for n in args.sizes:
+            results.append(report('data', bench_data(n)))
+    results.append(report('server', {"requests": server.requests}))
+    server.shutdown()
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
@@ -1,4 +1,6 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+import multiprocessing
 import functools
 import os
 import json
@@ -6,8 +8,9 @@ from typing import Literal
 
 from tqdm import tqdm
 
-from run import STRATEGY_MAP, gen_assistant, gen_user, gen_strategy, eval_all, RW_BIAS, print_all
-from MCTS import MCTS, Node
+import metrics
+from metrics import print_all
+from MCTS import MCTS
 
 
 tree_root = 'path_to_your_tree_folder'
@@ -23,9 +26,18 @@ perfer_N_min = 2
 is_extend_non_prefer = False
 non_prefer_sim_round = 4
 threads = 10
+# siblings of one tree extended concurrently, the tree is saved and drawn after every batch
+extend_workers = 16
+extend_batch = 64
 
 is_cmp = True
 
+# write records as JSONL tree by tree instead of one json at the end, trees are built in `processes`
+# worker processes with at most `window` trees in flight
+streaming = True
+processes = os.cpu_count()
+window = 4 * processes
+
 key_map = {
         "max_Q": lambda child: child.Q,
         "max_N": lambda child: child.N,
@@ -42,24 +54,54 @@ def find_end(node):
             return result
     return None
 
+class TreeIndex:
+    # one iterative walk over the tree: qualifying end nodes (in find_all_end order), the set of nodes on
+    # their paths, per-node parent/depth/children, and the negatives of each parent computed on demand
+    def __init__(self, root) -> None:
+        self.root = root
+        self.ends = []
+        self.parent = {root: None}
+        self.depth = {root: 0}
+        self.children = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            children = list(node.children)
+            self.children[node] = children
+            for child in children:
+                self.parent[child] = node
+                self.depth[child] = self.depth[node] + 1
+            stack.extend(reversed(children))
+            if node is not root and node.end and key_map[gold_label](node) >= end_min and node.N >= perfer_N_min:
+                self.ends.append(node)
+
+        self.on_path = set()
+        for node in self.ends:
+            while node is not None and node not in self.on_path:
+                self.on_path.add(node)
+                node = self.parent[node]
+        self._negatives = {}
+
+    def negatives(self, parent):
+        if parent not in self._negatives:
+            self._negatives[parent] = [
+                child for child in self.children[parent]
+                if key_map[gold_label](child) <= non_perfer_max and child.is_extend and child not in self.on_path
+            ]
+        return self._negatives[parent]
+
+    def parents_on_path(self):
+        # every parent of an on-path node once, deepest first along each end's path
+        seen = set()
+        for node in self.ends:
+            while self.parent[node] is not None and node not in seen:
+                seen.add(node)
+                yield node, self.parent[node]
+                node = self.parent[node]
+
+
 def find_all_end(node):
-    if len(node.children) == 0:
-        return []
-    ends = []
-    for child in node.children:
-        if child.end and key_map[gold_label](child) >= end_min and child.N >= perfer_N_min:
-            ends.append(child)
-        ends += find_all_end(child)
-    return ends
-
-def tag_end_path(end_list):
-    in_path = []
-    for end in end_list:
-        node: Node = end
-        while node is not None:
-            in_path.append(node)
-            node = node.parent
-    return in_path
+    return TreeIndex(node).ends
 
 
 def build_path(mcts: MCTS):
@@ -72,61 +114,103 @@ def build_path(mcts: MCTS):
     return historys
 
 def build_compare(mcts: MCTS):
-    node_list = find_all_end(mcts.tree)
-    in_path_list = tag_end_path(node_list)
-    if not node_list:
+    index = TreeIndex(mcts.tree)
+    if not index.ends:
         raise ValueError('not end')
     historys = []
-    for node in node_list:
-        history = []
-        while node.parent:
-            history.insert(0, {"role": "user", "content": node.user})
-            supporter_dict = {"role": "assistant", "content": node.assistant, "strategy": node.strategy, "negative": []}
-            used_strategy = []
-            for child in node.parent.children:
-                if child == node or key_map[gold_label](child) > non_perfer_max or not child.is_extend or child in in_path_list:
-                    continue
-                supporter_dict["negative"].append({"content": child.assistant, "strategy": child.strategy})
-                used_strategy.append(child.strategy)
-            history.insert(0, supporter_dict)
-            node = node.parent
-        history.insert(0, {"role": "user", "content": node.user})
-        history = history[:-1]
-        historys.append(history)
+    for node in index.ends:
+        history = [None] * (2 * index.depth[node] + 1)
+        i = len(history)
+        while index.parent[node] is not None:
+            parent = index.parent[node]
+            history[i - 1] = {"role": "user", "content": node.user}
+            # the end node and every other on-path node are never in negatives
+            history[i - 2] = {"role": "assistant", "content": node.assistant, "strategy": node.strategy, "negative": [
+                {"content": child.assistant, "strategy": child.strategy} for child in index.negatives(parent)
+            ]}
+            i -= 2
+            node = parent
+        history[0] = {"role": "user", "content": node.user}
+        historys.append(history[:-1])
     return historys
 
 
+def iter_tree_files(root):
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_file() and entry.name.endswith(('.pkl', '.tree')):
+            yield entry.path
+
+
+def build_records(tree_path, cmp=True):
+    mcts = MCTS.load(tree_path)
+    datas = build_compare(mcts) if cmp else build_path(mcts)
+    return [{
+        "description": mcts.description,
+        "scene": mcts.scene,
+        "iter": mcts.iter,
+        "messages": d
+    } for d in datas]
+
+
+def imap_bounded(executor, fn, iterable, window):
+    # like executor.map but only `window` tasks are submitted ahead, results come back in order
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_tree_records(root, cmp=True):
+    # records of every tree under root in tree order, built in `processes` worker processes
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for records in imap_bounded(executor, functools.partial(build_records, cmp=cmp), iter_tree_files(root), window):
+            yield from records
+
+
+def extend_tree(tree_path, pic_path):
+    extend_non_prefer(MCTS.load(tree_path), tree_path, pic_path)
+
+
+def extend_sibling(mcts: MCTS, child):
+    mcts.extend_node(child)
+    if child.end:
+        sim_history = child.build_history()
+        reward = mcts._reward(sim_history, 0)
+    else:
+        sim_history, sim_round, end = mcts._sim(child)
+        reward = mcts._reward(sim_history, sim_round)
+    child.Q = reward
+
+
 def extend_non_prefer(mcts: MCTS, tree_save_path, pic_save_path):
+    # run (and with it the LLM client) is only needed when trees are extended
+    from run import gen_assistant, gen_user, gen_strategy, eval_all, RW_BIAS
+
     mcts.gen_user_fn = functools.partial(gen_user, description=mcts.description, scene=mcts.scene)
     mcts.gen_assistant_fn = gen_assistant
     mcts.gen_strategy_fn = gen_strategy
     mcts.eval_all_fn = eval_all
     mcts.rw_bias = RW_BIAS
 
-    node_list = find_all_end(mcts.tree)
-    in_path_list = tag_end_path(node_list)
-    for node in tqdm(node_list):
-        while node.parent:
-            extend_flag = True
-            for child in node.parent.children:
-                if child != node and key_map[gold_label](child) <= non_perfer_max and child.is_extend and child not in in_path_list:
-                    extend_flag = False
-                    break
-            if extend_flag:
-                for child in node.parent.children:
-                    if child == node or child.is_extend:
-                        continue
-                    mcts.extend_node(child)
-                    if child.end:
-                        sim_history = child.build_history()
-                        reward = mcts._reward(sim_history, 0)
-                    else:
-                        sim_history, sim_round, end = mcts._sim(child)
-                        reward = mcts._reward(sim_history, sim_round)
-                    child.Q = reward
-                    mcts.save(tree_save_path)
-                    mcts.draw(pic_save_path)
-            node = node.parent
+    index = TreeIndex(mcts.tree)
+    # collect once per parent: a parent without negatives gets all its unextended children extended
+    pending = []
+    seen = set()
+    for _, parent in index.parents_on_path():
+        if parent in seen or index.negatives(parent):
+            continue
+        seen.add(parent)
+        pending += [child for child in index.children[parent] if not child.is_extend]
+
+    extend = metrics.in_context(functools.partial(extend_sibling, mcts))
+    with ThreadPoolExecutor(max_workers=extend_workers) as executor:
+        for i in tqdm(range(0, len(pending), extend_batch)):
+            list(executor.map(extend, pending[i:i + extend_batch]))
+            mcts.save(tree_save_path)
+            mcts.draw(pic_save_path)
     print_all()
 
 if __name__ =='__main__':
@@ -135,38 +219,31 @@ if __name__ =='__main__':
     os.makedirs(out_path, exist_ok=True)
 
     if is_cmp and is_extend_non_prefer:
+        tree_path_list = list(iter_tree_files(tree_root))
+        pic_path_list = [os.path.join(out_path, 'pic', os.path.splitext(os.path.basename(path))[0]) for path in tree_path_list]
         if threads <= 1:
-            for file in os.listdir(tree_root):
-                tree_path = os.path.join(tree_root, file)
-                mcts = MCTS.load(tree_path)
-                extend_non_prefer(mcts, tree_path, os.path.join(out_path, 'pic', os.path.splitext(file)[0]))
+            for tree_path, pic_path in zip(tree_path_list, pic_path_list):
+                extend_tree(tree_path, pic_path)
         else:
+            # trees are loaded inside the workers, not all up front
             with ThreadPoolExecutor(max_workers=threads) as executor:
-                tree_path_list = [os.path.join(tree_root, file) for file in os.listdir(tree_root)]
-                mcts_list = [MCTS.load(path) for path in tree_path_list]
-                pic_path_list = [os.path.join(out_path, 'pic', os.path.splitext(file)[0]) for file in os.listdir(tree_root)]
-                executor.map(extend_non_prefer, mcts_list, tree_path_list, pic_path_list)
+                list(executor.map(extend_tree, tree_path_list, pic_path_list))
         print_all()
 
-    data_list = []
-    for file in os.listdir(tree_root):
-        tree_path = os.path.join(tree_root, file)
-        mcts = MCTS.load(tree_path)
-        if is_cmp:
-            datas = build_compare(mcts)
-        else:
-            datas = build_path(mcts)
-        for d in datas:
-            data_list.append({
-                "description": mcts.description,
-                "scene": mcts.scene,
-                "iter": mcts.iter,
-                "messages": d
-            })
-    print(len(data_list))
-
     out_name = f'{tree_folder}_{gold_label}{"_cmp" if is_cmp else ""}{"_extend" if is_extend_non_prefer and is_cmp else ""}'
-    with open(os.path.join(out_path, f'{out_name}.json'), 'w', encoding='utf-8') as f:
-        json.dump(data_list, f, ensure_ascii=False, indent=2)
-
 
+    if streaming:
+        num = 0
+        with open(os.path.join(out_path, f'{out_name}.jsonl'), 'w', encoding='utf-8') as f:
+            for record in tqdm(iter_tree_records(tree_root, is_cmp)):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                num += 1
+        print(num)
+    else:
+        data_list = []
+        for tree_path in iter_tree_files(tree_root):
+            data_list += build_records(tree_path, is_cmp)
+        print(len(data_list))
+
+        with open(os.path.join(out_path, f'{out_name}.json'), 'w', encoding='utf-8') as f:
+            json.dump(data_list, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResponseCache:
+    # hits only touch `used` in memory; the touches are written with the next put(), every touch_batch hits and on close(),
+    # so reads stay out of the WAL writer lock that other scheduler processes share
+    def __init__(self, path, max_bytes=None, read_only=False, touch_batch=256) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.touch_batch = touch_batch
+        self._lock = threading.Lock()
+        self._conn = None
+        self._touched: dict[str, float] = {}
+        if read_only:
+            if os.path.exists(path):
+                self._conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS response_used ON response (used)')
+        self._conn.commit()
+        self._size = self._total_size()
+
+    @staticmethod
+    def key(model, system, query, params) -> str:
+        raw = json.dumps([model, system, query, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _total_size(self):
+        return self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+
+    def get(self, key):
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if not self.read_only:
+                self._touched[key] = time.time()
+                if len(self._touched) >= self.touch_batch:
+                    self._flush_touches()
+                    self._conn.commit()
+        return row[0]
+
+    def _flush_touches(self):
+        if self._touched:
+            self._conn.executemany('UPDATE response SET used = ? WHERE key = ?', [(used, key) for key, used in self._touched.items()])
+            self._touched = {}
+
+    def put(self, key, value):
+        if self.read_only or value is None:
+            return
+        size = len(key) + len(value.encode('utf-8'))
+        with self._lock:
+            self._flush_touches()
+            self._conn.execute('INSERT OR REPLACE INTO response (key, value, size, used) VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self._conn.commit()
+            self._size += size
+            if self.max_bytes is not None and self._size > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        if self.read_only:
+            return
+        with self._lock:
+            self._touched.pop(key, None)
+            self._conn.execute('DELETE FROM response WHERE key = ?', (key,))
+            self._conn.commit()
+
+    def _evict(self):
+        # other processes may share the file, so re-read the real size before evicting
+        self._size = self._total_size()
+        target = self.max_bytes * 0.9
+        while self._size > target:
+            rows = self._conn.execute('SELECT key, size FROM response ORDER BY used LIMIT 256').fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                keys.append(key)
+                self._size -= size
+                if self._size <= target:
+                    break
+            self._conn.executemany('DELETE FROM response WHERE key = ?', [(k,) for k in keys])
+            self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                if not self.read_only:
+                    self._flush_touches()
+                    self._conn.commit()
+            self._conn.close()
+            self._conn = None
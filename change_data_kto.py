@@ -38,55 +38,61 @@ You should response in the following format:
 in_file = ''
 out_file =''
 
-with open(in_file, 'r', encoding='utf-8') as f:
-    data = json.load(f)
-
-change_data = []
-
-for d in data:
-    for i in range(1, len(d['messages']), 2):
-        message = d['messages'][:i]
-        message = [{
-            "role": m['role'],
-            "content": m['content'] if m['role'] == 'user' else f"({m['strategy']}) {m['content']}",
-        } for m in message]
-        message.insert(0, {
-            'role': 'system',
-            'content': SYSTEM
-        })
-        change_data.append({
-            "scene": d['scene'],
-            "description": d['description'],
-            "messages": message + [{
-                "role": 'assistant',
-                "content": f"({d['messages'][i]['strategy']}) {d['messages'][i]['content']}",
-            }],
-            "label": True
-        })
-        for n in d['messages'][i]['negative']:
+
+def convert(data):
+    change_data = []
+
+    for d in data:
+        for i in range(1, len(d['messages']), 2):
+            message = d['messages'][:i]
+            message = [{
+                "role": m['role'],
+                "content": m['content'] if m['role'] == 'user' else f"({m['strategy']}) {m['content']}",
+            } for m in message]
+            message.insert(0, {
+                'role': 'system',
+                'content': SYSTEM
+            })
             change_data.append({
                 "scene": d['scene'],
                 "description": d['description'],
                 "messages": message + [{
                     "role": 'assistant',
-                    "content": f"({n['strategy']}) {n['content']}",
+                    "content": f"({d['messages'][i]['strategy']}) {d['messages'][i]['content']}",
                 }],
-                "label": False
+                "label": True
             })
+            for n in d['messages'][i]['negative']:
+                change_data.append({
+                    "scene": d['scene'],
+                    "description": d['description'],
+                    "messages": message + [{
+                        "role": 'assistant',
+                        "content": f"({n['strategy']}) {n['content']}",
+                    }],
+                    "label": False
+                })
+
+    print(len(change_data))
+
+    seen = set()
+    unique_dict_list = []
 
-print(len(change_data))
+    for d in change_data:
+        serialized_d = json.dumps(d, sort_keys=True)
+        if serialized_d not in seen:
+            seen.add(serialized_d)
+            unique_dict_list.append(d)
+    return unique_dict_list
 
-seen = set()
-unique_dict_list = []
 
-for d in change_data:
-    serialized_d = json.dumps(d, sort_keys=True)
-    if serialized_d not in seen:
-        seen.add(serialized_d)
-        unique_dict_list.append(d)
+if __name__ == '__main__':
+    with open(in_file, 'r', encoding='utf-8') as f:
+        data = [json.loads(line) for line in f] if in_file.endswith('.jsonl') else json.load(f)
 
-print(len(unique_dict_list))
+    unique_dict_list = convert(data)
 
-with open(out_file, 'w', encoding='utf-8') as f:
-    json.dump(unique_dict_list, f, ensure_ascii=False, indent=2)
+    print(len(unique_dict_list))
 
+    with open(out_file, 'w', encoding='utf-8') as f:
+        json.dump(unique_dict_list, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,212 @@
+import json
+import hashlib
+
+from change_data import SYSTEM
+
+
+# build_data output (.jsonl streams, .json is loaded whole), '' skips that output
+in_file = ''
+# or read the trees directly (build_data compare records, build_data settings apply) without an intermediate file
+tree_root = ''
+pair_file = ''
+kto_file = ''
+# prefix-shared format holding both datasets, read back with CompactDataset
+compact_file = ''
+
+
+def iter_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def _prompt(d):
+    # system prompt plus every turn rendered once, the prefix for turn i is prompt[:i + 1]
+    return [{"role": 'system', "content": SYSTEM}] + [{
+        "role": 'user' if m['role'] == 'user' else 'assistant',
+        "content": m['content'] if m['role'] == 'user' else f"({m['strategy']}) {m['content']}",
+    } for m in d['messages']]
+
+
+def pair_records(d):
+    prompt = _prompt(d)
+    for i in range(1, len(d['messages']), 2):
+        message = prompt[:i + 1]
+        for n in d['messages'][i]['negative']:
+            yield {
+                "scene": d['scene'],
+                "description": d['description'],
+                "messages": message,
+                "chosen": prompt[i + 1],
+                "reject": {
+                    "role": 'assistant',
+                    "content": f"({n['strategy']}) {n['content']}",
+                }
+            }
+
+
+def kto_records(d):
+    prompt = _prompt(d)
+    for i in range(1, len(d['messages']), 2):
+        message = prompt[:i + 1]
+        yield {
+            "scene": d['scene'],
+            "description": d['description'],
+            "messages": message + [prompt[i + 1]],
+            "label": True
+        }
+        for n in d['messages'][i]['negative']:
+            yield {
+                "scene": d['scene'],
+                "description": d['description'],
+                "messages": message + [{
+                    "role": 'assistant',
+                    "content": f"({n['strategy']}) {n['content']}",
+                }],
+                "label": False
+            }
+
+
+class Dedupe:
+    # keeps a 16 byte digest of each canonical record instead of the record itself
+    def __init__(self) -> None:
+        self.seen = set()
+        self.total = 0
+
+    def __call__(self, records):
+        for record in records:
+            self.total += 1
+            digest = hashlib.blake2b(json.dumps(record, sort_keys=True).encode('utf-8'), digest_size=16).digest()
+            if digest not in self.seen:
+                self.seen.add(digest)
+                yield record
+
+
+def _digest(*parts):
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode('utf-8'), digest_size=16)
+
+
+def compact_records(data):
+    # one system line, each conversation once (rendered turns without the system prompt), then its examples:
+    #   pair: conversation id, prefix length, reject        chosen is turn `prefix` of the conversation
+    #   kto:  conversation id, prefix length, label[, completion]   completion defaults to turn `prefix`
+    # examples are deduped like convert() through a running digest of the prefix instead of whole records
+    yield {"type": 'system', "id": 0, "content": SYSTEM}
+    seen = set()
+    num = 0
+    for d in data:
+        turns = _prompt(d)[1:]
+        running = _digest(d['scene'], d['description'])
+        conversation = None
+        for i, turn in enumerate(turns):
+            if i % 2 == 1:
+                examples = [({"type": 'kto', "prefix": i, "label": True}, ('kto', True, turn))]
+                for n in d['messages'][i]['negative']:
+                    reject = {"role": 'assistant', "content": f"({n['strategy']}) {n['content']}"}
+                    examples.append(({"type": 'pair', "prefix": i, "reject": reject}, ('pair', turn, reject)))
+                    examples.append(({"type": 'kto', "prefix": i, "label": False, "completion": reject}, ('kto', False, reject)))
+                for example, key in examples:
+                    digest = running.copy()
+                    digest.update(json.dumps(key, sort_keys=True).encode('utf-8'))
+                    digest = digest.digest()
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                    if conversation is None:
+                        conversation = num
+                        num += 1
+                        yield {"type": 'conversation', "id": conversation, "system": 0, "scene": d['scene'], "description": d['description'], "messages": turns}
+                    yield example | {"conversation": conversation}
+            running.update(json.dumps(turn, sort_keys=True).encode('utf-8'))
+
+
+class CompactDataset:
+    # keeps the shared conversations and the small example records, full records are built on access
+    def __init__(self, path, kind='pair') -> None:
+        self.kind = kind
+        self.systems = {}
+        self.conversations = {}
+        self.examples = []
+        for record in iter_records(path):
+            if record['type'] == 'system':
+                self.systems[record['id']] = record['content']
+            elif record['type'] == 'conversation':
+                self.conversations[record['id']] = record
+            elif record['type'] == kind:
+                self.examples.append(record)
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.expand(self.examples[i])
+
+    def __iter__(self):
+        for example in self.examples:
+            yield self.expand(example)
+
+    def expand(self, example):
+        conversation = self.conversations[example['conversation']]
+        prefix = example['prefix']
+        message = [{"role": 'system', "content": self.systems[conversation['system']]}] + conversation['messages'][:prefix]
+        chosen = conversation['messages'][prefix]
+        if example['type'] == 'pair':
+            return {"scene": conversation['scene'], "description": conversation['description'], "messages": message, "chosen": chosen, "reject": example['reject']}
+        return {"scene": conversation['scene'], "description": conversation['description'], "messages": message + [example.get('completion', chosen)], "label": example['label']}
+
+
+def write_records(data, pair_out, kto_out, pair_dedupe, kto_dedupe):
+    # writes the unique pair / KTO records of each conversation and passes the conversation on
+    for d in data:
+        if pair_out is not None:
+            for record in pair_dedupe(pair_records(d)):
+                pair_out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if kto_out is not None:
+            for record in kto_dedupe(kto_records(d)):
+                kto_out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        yield d
+
+
+def convert(data, pair_out=None, kto_out=None):
+    # one pass over the conversations, unique records are written to the open JSONL files as they come
+    pair_dedupe, kto_dedupe = Dedupe(), Dedupe()
+    for _ in write_records(data, pair_out, kto_out, pair_dedupe, kto_dedupe):
+        pass
+    return pair_dedupe, kto_dedupe
+
+
+def iter_input():
+    if tree_root:
+        from build_data import iter_tree_records
+        return iter_tree_records(tree_root)
+    return iter_records(in_file)
+
+
+if __name__ == '__main__':
+    pair_out = open(pair_file, 'w', encoding='utf-8') if pair_file else None
+    kto_out = open(kto_file, 'w', encoding='utf-8') if kto_file else None
+    compact_out = open(compact_file, 'w', encoding='utf-8') if compact_file else None
+    pair_dedupe, kto_dedupe = Dedupe(), Dedupe()
+    try:
+        # a single pass over the input feeds every requested output
+        data = write_records(iter_input(), pair_out, kto_out, pair_dedupe, kto_dedupe)
+        if compact_out is not None:
+            for record in compact_records(data):
+                compact_out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        else:
+            for _ in data:
+                pass
+    finally:
+        for f in (pair_out, kto_out, compact_out):
+            if f is not None:
+                f.close()
+    if pair_out is not None:
+        print(f'pair: {pair_dedupe.total} records, {len(pair_dedupe.seen)} unique -> {pair_file}')
+    if kto_out is not None:
+        print(f'kto: {kto_dedupe.total} records, {len(kto_dedupe.seen)} unique -> {kto_file}')
+    if compact_out is not None:
+        print(f'compact -> {compact_file}')
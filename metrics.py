@@ -0,0 +1,108 @@
+import os
+import json
+import threading
+import contextvars
+import contextlib
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+COUNTERS = ('calls', 'failures', 'retries', 'parse_failures', 'cache_hits', 'prompt_tokens', 'completion_tokens')
+
+
+class Metrics:
+    # per-role LLM counters and latency histogram, role is strategy / assistant / user / eval
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.roles: dict[str, dict] = {}
+
+    def _role(self, role):
+        if role not in self.roles:
+            self.roles[role] = {k: 0 for k in COUNTERS} | {"seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.roles[role]
+
+    def inc(self, role, name, n=1):
+        with self._lock:
+            self._role(role)[name] += n
+
+    def observe(self, role, seconds, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            r = self._role(role)
+            r["calls"] += 1
+            r["seconds"] += seconds
+            r["prompt_tokens"] += prompt_tokens
+            r["completion_tokens"] += completion_tokens
+            r["buckets"][sum(seconds > b for b in LATENCY_BUCKETS)] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {role: dict(r, buckets=dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], r["buckets"]))) for role, r in self.roles.items()}
+
+    def to_prometheus(self, prefix='cso_llm'):
+        lines = []
+        data = self.to_dict()
+        for name in COUNTERS:
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines += [f'{prefix}_{name}_total{{role="{role}"}} {r[name]}' for role, r in data.items()]
+        lines.append(f'# TYPE {prefix}_latency_seconds histogram')
+        for role, r in data.items():
+            total = 0
+            for le, count in r["buckets"].items():
+                total += count
+                lines.append(f'{prefix}_latency_seconds_bucket{{role="{role}",le="{le}"}} {total}')
+            lines.append(f'{prefix}_latency_seconds_sum{{role="{role}"}} {r["seconds"]}')
+            lines.append(f'{prefix}_latency_seconds_count{{role="{role}"}} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        # .prom writes a Prometheus textfile, anything else JSON
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+
+METRICS = Metrics()
+# extra registries (e.g. one per tree) that also receive everything recorded in this context
+_scopes = contextvars.ContextVar('metrics_scopes', default=())
+_role = contextvars.ContextVar('metrics_role', default='other')
+
+
+def current_role():
+    return _role.get()
+
+@contextlib.contextmanager
+def role(name):
+    token = _role.set(name)
+    try:
+        yield
+    finally:
+        _role.reset(token)
+
+@contextlib.contextmanager
+def scope(metrics: Metrics):
+    token = _scopes.set(_scopes.get() + (metrics,))
+    try:
+        yield metrics
+    finally:
+        _scopes.reset(token)
+
+def inc(name, n=1, role=None):
+    for m in (METRICS, *_scopes.get()):
+        m.inc(role or _role.get(), name, n)
+
+def observe(seconds, prompt_tokens=0, completion_tokens=0, role=None):
+    for m in (METRICS, *_scopes.get()):
+        m.observe(role or _role.get(), seconds, prompt_tokens, completion_tokens)
+
+def in_context(fn):
+    # thread pools do not carry context variables, wrap the submitted function to keep role and scopes
+    ctx = contextvars.copy_context()
+    def wrapper(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return wrapper
+
+def print_all():
+    print(json.dumps(METRICS.to_dict(), indent=2))
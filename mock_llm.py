@@ -0,0 +1,123 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+STRATEGIES = [
+    'Emotional Validation',
+    'Affirmation',
+    'Collaborative Planning',
+    'Empathetic Statements',
+    'Avoid Judgment and Criticism',
+    'Provide Different Perspectives',
+    'Reframe Negative Thoughts',
+    'Share Information',
+]
+
+
+class MockLLM(ThreadingHTTPServer):
+    # OpenAI-compatible /chat/completions stub for benchmarks: replies are a deterministic function of the prompt
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, end_rate=0.15, seed=0) -> None:
+        super().__init__(('127.0.0.1', port), MockHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.end_rate = end_rate
+        self.seed = seed
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def roll(self):
+        # latency and injected errors vary per request, so a retried prompt can succeed
+        with self._lock:
+            self.requests += 1
+            return self._rng.random(), self._rng.uniform(0.5, 1.5)
+
+    def reply(self, messages):
+        query = messages[-1]['content']
+        system = messages[0]['content'] if messages[0]['role'] == 'system' else ''
+        rng = random.Random(hashlib.sha256(f'{self.seed}{system}{query}'.encode('utf-8')).hexdigest())
+        if 'rate the feasibility' in query:
+            scores = {s: rng.randint(0, 10) for s in STRATEGIES}
+            return f'The seeker needs comfort first.\n```json\n{json.dumps(scores)}\n```'
+        if 'impartial scoring judge' in query and '[Turn ' in query:
+            turns = len(re.findall(r'\[Turn \d+\]', query))
+            return '\n'.join(f'Turn {n + 1}: ' + ', '.join(str(rng.randint(0, 4)) for _ in range(4)) for n in range(turns))
+        if 'impartial scoring judge' in query:
+            return '\n'.join(f'{i + 1}: {rng.randint(0, 4)}' for i in range(4))
+        if 'sought out a supporter' in system:
+            turns = len(re.findall(r'^supporter: ', query, re.M))
+            if rng.random() < self.end_rate * turns:
+                return '</end/>'
+            return f'I just feel stuck, {rng.choice(["work", "school", "home"])} keeps getting worse.'
+        return f'That sounds really hard, tell me more about {rng.choice(["it", "that", "how you feel"])}.'
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockLLM
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if not self.path.endswith('/chat/completions'):
+            self._send(404, {"error": {"message": f'unknown path {self.path}'}})
+            return
+        error, jitter = self.server.roll()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency * jitter)
+        if error < self.server.error_rate:
+            if error < self.server.error_rate / 2:
+                self._send(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {'retry-after-ms': '10'})
+            else:
+                self._send(500, {"error": {"message": "server error", "type": "server_error"}})
+            return
+        content = self.server.reply(body['messages'])
+        prompt_tokens = sum(len(m['content']) for m in body['messages']) // 4
+        completion_tokens = len(content) // 4
+        self._send(200, {
+            "id": f'chatcmpl-mock-{self.server.requests}',
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'mock'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--end-rate', type=float, default=0.15)
+    args = parser.parse_args()
+    server = MockLLM(args.port, args.latency, args.error_rate, args.end_rate)
+    print(f'serving on {server.url}')
+    server.serve_forever()
@@ -0,0 +1,53 @@
+import time
+import asyncio
+import threading
+
+
+class RateLimiter:
+    # requests/min and tokens/min buckets; callers reserve capacity up front and sleep off any debt
+    def __init__(self, rpm=0, tpm=0) -> None:
+        self.capacity = {"requests": rpm, "tokens": tpm}
+        self.level = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        for k, capacity in self.capacity.items():
+            if capacity > 0:
+                self.level[k] = min(capacity, self.level[k] + elapsed * capacity / 60)
+
+    def reserve(self, tokens) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = max(0, self.paused_until - now)
+            for k, amount in (("requests", 1), ("tokens", tokens)):
+                if self.capacity[k] > 0:
+                    self.level[k] -= amount
+                    if self.level[k] < 0:
+                        wait = max(wait, -self.level[k] * 60 / self.capacity[k])
+            return wait
+
+    def correct(self, tokens):
+        # charge the difference between the estimate and the usage the API reported
+        with self._lock:
+            if self.capacity["tokens"] > 0:
+                self.level["tokens"] -= tokens
+
+    def pause(self, seconds):
+        # a 429 stops every caller, not just the thread that saw it
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
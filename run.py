@@ -9,8 +9,10 @@ from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
 
-from util import retry, history_to_str, generate
+from util import retry, history_to_str, generate, render_turn
+import metrics
 from MCTS import MCTS
+from scheduler import schedule
 
 
 CHARA_DETAIL = '''
@@ -163,6 +165,21 @@ Please follow the response format below strictly, avoiding any positional bias a
 ROUND_QUESTION_NUM = 4
 ROUND_WEIGHT = [0.1, 0.1, 0.1, 0.7]
 
+# same rubric as EVAL_ROUND_PROMPT, but every marked supporter turn is scored in one request
+EVAL_MULTI_PROMPT = EVAL_ROUND_PROMPT[:EVAL_ROUND_PROMPT.index('Your task')] + '''Your task is to act as an impartial scoring judge and rate each response of supporter marked with [Turn <n>] in the dialog in terms of the following aspects in order to evaluate the quality of the responses. Rate every marked response only on the dialog up to and including it, as if it were the last response. Please read and fully understand the following scoring criteria.
+
+Note that please give the scores in the specified format, just the turn number and the scores of the dimensions in order, without repeating the questions themselves. Also, do not add other extraneous prefixes and control characters.
+
+''' + EVAL_ROUND_PROMPT[EVAL_ROUND_PROMPT.index('## Evaluation Criteria:'):EVAL_ROUND_PROMPT.index('What you need to do')] + '''What you need to do to evaluate this document:
+{chat_history}
+
+Please follow the response format below strictly, one line for every marked turn, avoiding any positional bias and not letting the length of your response affect your evaluation. Evaluate the areas as objectively as possible.
+
+## Answer format:
+
+Turn <Turn number>: <Score of (1)>, <Score of (2)>, <Score of (3)>, <Score of (4)>
+'''
+
 
 FIX_PROMPT = '''
 Here are the wrong responses and the reasons for their errors, so please learn from them and don't repeat them:
@@ -191,10 +208,10 @@ def build_strategy_prompt(chat_history):
     return STRATEGY_SYS_PROMPT, STRATEGY_QUERY.format(chat_history=history_to_str(chat_history, strategy=True), stratrgy_str=stratrgy_str)
 
     
-@retry()
+@retry(role='strategy')
 def gen_strategy(history, temperature=5):
     sys, query = build_strategy_prompt(history)
-    output, in_token, out_token = generate(query, sys)
+    output = generate(query, sys)
 
     match = re.findall(r'```.+?```', output, re.DOTALL)
     if len(match) == 1:
@@ -212,7 +229,7 @@ def gen_strategy(history, temperature=5):
         score['score'] = exp_list[i] / sum_exp_values
     return score_list
 
-@retry()
+@retry(role='eval')
 def eval_round(history, strategy=None, assistant=None):
     query = EVAL_ROUND_PROMPT.format(chat_history=history_to_str(history + ([{"role": "supporter", "content": assistant, "strategy": strategy}] if assistant else []), strategy=True))
     output = generate(query)
@@ -227,7 +244,7 @@ def eval_round(history, strategy=None, assistant=None):
         score += int(matches.group(1)) * ROUND_WEIGHT[i]
     return score
 
-@retry()
+@retry(role='assistant')
 def gen_assistant(history, strategy):
     sys, query = build_supporter_prompt(history, strategy)
     output = generate(query, sys)
@@ -235,7 +252,7 @@ def gen_assistant(history, strategy):
     return output.removeprefix('supporter').removeprefix('Supporter').strip("\"\': ")
 
 
-@retry()
+@retry(role='user')
 def gen_user(history, description, scene) -> tuple[str, int]:
     sys, query = build_user_prompt(history, description, scene)
     output = generate(query, sys)
@@ -247,18 +264,70 @@ def gen_user(history, description, scene) -> tuple[str, int]:
         end = True
     return output, end
 
-@retry()
-def eval_all(history, sim_round):
+@retry(role='eval', parse_attempts=1)
+def eval_rounds(history, ends):
+    # scores history[end - 1] (a supporter turn) for every end in one request, a bad answer is not retried here
+    marks = {end - 1: n + 1 for n, end in enumerate(ends)}
+    chat_history = ''.join((f'[Turn {marks[i]}] ' if i in marks else '') + render_turn(h, True) for i, h in enumerate(history[:ends[-1]]))[:-1]
+    output = generate(EVAL_MULTI_PROMPT.format(chat_history=chat_history))
+
     score_list = []
+    for n in range(1, len(ends) + 1):
+        matches = re.search(rf'Turn\s*{n}(?!\d)\s*:?\s*' + r'\D{0,8}?'.join([r'([0-4])'] * ROUND_QUESTION_NUM), output, re.I)
+        if not matches:
+            print(repr(output))
+            raise ValueError('bad eval rounds')
+        score_list.append(sum(int(matches.group(i + 1)) * ROUND_WEIGHT[i] for i in range(ROUND_QUESTION_NUM)))
+    return score_list
+
+def eval_all(history, sim_round):
+    # the last sim_round + 1 supporter turns, in one judge request or one per prefix (eval_round retries each on its own)
     history = history[1:]
-    for i in range(len(history) - sim_round * 2 - 1, len(history), 2):
-        # print(history[:i])
-        score_list.append(eval_round(history[:i]))
+    ends = list(range(len(history) - sim_round * 2 - 1, len(history), 2))
+    if EVAL_MODE == 'multi' and len(ends) > 1:
+        try:
+            score_list = eval_rounds(history, ends)
+            return sum(score_list)/len(score_list)
+        except ValueError:
+            print('multi-round eval failed to parse, scoring rounds one by one')
+    prefix_list = [history[:i] for i in ends]
+    if len(prefix_list) == 1:
+        score_list = [eval_round(prefix_list[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(prefix_list)) as executor:
+            score_list = list(executor.map(metrics.in_context(eval_round), prefix_list))
     return sum(score_list)/len(score_list)
 
 
 C = 1
 RW_BIAS = -3
+# 'round': one judge request per rolled out supporter turn, 'multi': all of them in one request (per round on a bad answer);
+# 'multi' lets the judge see the later turns, so its rewards are not comparable with trees scored per round
+EVAL_MODE = 'round'
+# concurrent MCTS passes inside one tree, 1 runs the original serial loop
+TREE_WORKERS = 1
+# 'journal' appends each iteration to tmp/*.journal and snapshots the pickle every SNAPSHOT_EVERY iterations
+CHECKPOINT = 'journal'
+SNAPSHOT_EVERY = 20
+# 'never', 'every' (tmp picture every RENDER_EVERY iterations, rendered in the background) or 'final' (only pic/ at the end)
+RENDER = 'final'
+RENDER_EVERY = 10
+# 'array' keeps the tree in a numpy TreeStore, useful for trees with thousands of nodes
+TREE_STORE = 'node'
+# keep rollout turns and strategy scores on the node they started from so growing the tree along the rollout reuses them
+# (changes which turns the search sees, so it is opt-in like TREE_WORKERS and TREE_STORE)
+REUSE_ROLLOUTS = False
+# finished trees: 'tree' (versioned columnar file, statistics loadable without the text) or 'pkl'
+TREE_FORMAT = 'tree'
+# stop before min_iter once the best path's visit shares and Q (within CONVERGE_TOL) hold for CONVERGE_PATIENCE
+# iterations and the root's best child is separated from its siblings at confidence 1 - CONVERGE_DELTA (eval scores
+# span 0-4), 0 turns it off; seeded golden-path visits are not counted, siblings and levels with fewer than
+# CONVERGE_MIN_VISITS visits are left out (ends trees before min_iter, so it is opt-in like REUSE_ROLLOUTS)
+CONVERGE_PATIENCE = 0
+CONVERGE_MIN_ITER = 30
+CONVERGE_DELTA = 0.1
+CONVERGE_TOL = 0.05
+CONVERGE_MIN_VISITS = 10
 
 def call_mcts(json_data, save_name):
     mcts = MCTS(
@@ -269,7 +338,20 @@ def call_mcts(json_data, save_name):
         gen_assistant_fn=gen_assistant,
         gen_user_fn=gen_user,
         eval_all_fn=eval_all,
-        rw_bias=RW_BIAS
+        rw_bias=RW_BIAS,
+        workers=TREE_WORKERS,
+        checkpoint=CHECKPOINT,
+        snapshot_every=SNAPSHOT_EVERY,
+        render=RENDER,
+        render_every=RENDER_EVERY,
+        tree_store=TREE_STORE,
+        reuse_rollouts=REUSE_ROLLOUTS,
+        converge_patience=CONVERGE_PATIENCE,
+        converge_min_iter=CONVERGE_MIN_ITER,
+        converge_delta=CONVERGE_DELTA,
+        reward_range=4,
+        converge_tol=CONVERGE_TOL,
+        converge_min_visits=CONVERGE_MIN_VISITS,
     )
     mcts.run(
         description = json_data['description'],
@@ -279,10 +361,12 @@ def call_mcts(json_data, save_name):
         max_iter=200,
         max_end=25,
         tmp_path=f'tmp/{save_name}',
-        json_data=json_data
+        json_data=json_data,
+        metrics_path=f'output/metrics/{save_name}.json',
     )
-    mcts.save(f'output/tree/{save_name}.pkl')
-    mcts.draw(f'pic/{save_name}')
+    mcts.save(f'output/tree/{save_name}.{TREE_FORMAT}')
+    if RENDER != 'never':
+        mcts.draw(f'pic/{save_name}')
 
 if __name__ == '__main__':
 
@@ -294,15 +378,11 @@ if __name__ == '__main__':
 
     data_list = data_list[start:end]
 
+    # trees run in `processes` worker processes with `threads` trees each, progress is kept in a manifest
+    # next to the trees so a rerun skips finished dialogues and resumes interrupted ones
+    processes = 4
     threads = 10
 
     save_root = f'path_to_your_tree_folder'
 
-    if threads <= 1:
-        for situation, i in zip(data_list, range(start, end)):
-            call_mcts(situation, f'{save_root}/{start}-{end}/{i}')
-    else:
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            executor.map(call_mcts, data_list, [f'{save_root}/{start}-{end}/{i}' for i in range(start, end)])
-
-
+    schedule(data_list, f'{save_root}/{start}-{end}', start=start, processes=processes, threads=threads)
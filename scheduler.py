@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import queue
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class Manifest:
+    # pending / running / done / failed per dialogue index, rewritten atomically at most every `interval`
+    # seconds (save(force=True) writes the rest); a rewrite per change is quadratic over thousands of jobs
+    def __init__(self, path, interval=1.0) -> None:
+        self.path = path
+        self.interval = interval
+        self.jobs: dict[str, dict] = {}
+        self._saved_at = 0.0
+        self._dirty = False
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.jobs = json.load(f)
+
+    def status(self, index):
+        return self.jobs.get(str(index), {}).get('status')
+
+    def set(self, index, status, save=True, **extra):
+        job = self.jobs.setdefault(str(index), {"attempts": 0})
+        job.update(extra, status=status, updated=time.time())
+        if status == 'running':
+            job['attempts'] += 1
+        self._dirty = True
+        if save:
+            self.save()
+
+    def save(self, force=False):
+        if not self._dirty or (not force and time.monotonic() - self._saved_at < self.interval):
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.jobs, f, ensure_ascii=False)
+        os.replace(f'{self.path}.tmp', self.path)
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    def summary(self):
+        counts = {}
+        for job in self.jobs.values():
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+
+def _worker(tasks, events, threads, metrics_path, rate_share=1):
+    # one process: `threads` trees at a time, pulling jobs until it gets a None per thread.
+    # Each process limits itself to 1/rate_share of the configured rpm / tpm, so together they keep the quota;
+    # a 429 pauses only the process that saw it
+    os.environ['openai_rate_share'] = str(rate_share)
+    import run
+    from metrics import METRICS
+
+    def loop():
+        while True:
+            job = tasks.get()
+            if job is None:
+                return
+            index, data, save_name = job
+            events.put(('running', index, None))
+            try:
+                run.call_mcts(data, save_name)
+                events.put(('done', index, None))
+            except Exception:
+                events.put(('failed', index, traceback.format_exc()))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(loop) for _ in range(threads)]
+    for future in futures:
+        future.result()
+    METRICS.export(metrics_path)
+
+
+def schedule(data_list, save_root, start=0, processes=4, threads=4, manifest_path=None, retry_failed=False):
+    # processes=0 runs the worker threads in this process
+    manifest = Manifest(manifest_path or f'output/tree/{save_root}/manifest.json')
+    jobs = []
+    for i, data in enumerate(data_list, start):
+        save_name = f'{save_root}/{i}'
+        if any(os.path.exists(f'output/tree/{save_name}.{ext}') for ext in ('tree', 'pkl')):
+            if manifest.status(i) != 'done':
+                manifest.set(i, 'done', save=False, save_name=save_name)
+            continue
+        if manifest.status(i) == 'failed' and not retry_failed:
+            continue
+        # 'running' left over from a preempted run resumes from its tmp checkpoint
+        manifest.set(i, 'pending', save=False, save_name=save_name, error=None)
+        jobs.append((i, data, save_name))
+    manifest.save(force=True)
+    print(f'{len(jobs)} jobs to run, {manifest.summary()}')
+    if not jobs:
+        return manifest
+
+    ctx = multiprocessing.get_context('spawn')
+    manager = ctx.Manager() if processes > 0 else None
+    try:
+        tasks, events = (manager.Queue(), manager.Queue()) if manager else (queue.Queue(), queue.Queue())
+        for job in jobs:
+            tasks.put(job)
+        for _ in range(max(processes, 1) * threads):
+            tasks.put(None)
+
+        if processes > 0:
+            pool = ProcessPoolExecutor(max_workers=processes, mp_context=ctx)
+            futures = [pool.submit(_worker, tasks, events, threads, f'output/metrics/{save_root}/worker-{n}.prom', processes) for n in range(processes)]
+        else:
+            pool = ThreadPoolExecutor(max_workers=1)
+            futures = [pool.submit(_worker, tasks, events, threads, f'output/metrics/{save_root}/worker-0.prom')]
+
+        remaining = len(jobs)
+        while remaining:
+            try:
+                status, index, error = events.get(timeout=5)
+            except queue.Empty:
+                manifest.save()
+                if all(f.done() for f in futures):
+                    break
+                continue
+            manifest.set(index, status, error=error)
+            if status in ('done', 'failed'):
+                remaining -= 1
+                print(f'[{len(jobs) - remaining}/{len(jobs)}] {index} {status}')
+                if error:
+                    print(error)
+        pool.shutdown()
+        for future in futures:
+            future.result()
+    finally:
+        manifest.save(force=True)
+        if manager:
+            manager.shutdown()
+
+    summary = manifest.summary()
+    print(f'finished: {summary}')
+    failed = [i for i, job in manifest.jobs.items() if job['status'] == 'failed']
+    if failed:
+        print(f'failed indices: {failed}, see {manifest.path} for tracebacks')
+    return manifest
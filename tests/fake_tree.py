@@ -0,0 +1,57 @@
+import zlib
+
+from MCTS import MCTS
+
+
+STRATEGIES = ['Emotional Validation', 'Affirmation', 'Collaborative Planning']
+
+
+def _hash(*parts):
+    return zlib.crc32(repr(parts).encode('utf-8'))
+
+
+# deterministic stand-ins for the LLM calls in run.py, every answer depends only on the dialogue so far
+def gen_strategy(history):
+    return [{"strategy": s, "score": (_hash(len(history), s) % 100 + 1) / 101} for s in STRATEGIES]
+
+
+def gen_assistant(history, strategy):
+    return f'{strategy} #{len(history)} {_hash(history[-1]["content"], strategy) % 1000}'
+
+
+def gen_user(history, description=None, scene=None):
+    return f'seeker #{len(history)} \u00e9\u4f60 {_hash(history[-1]["content"]) % 1000}', len(history) >= 9
+
+
+def eval_all(history, sim_round):
+    return _hash(history[-1]["content"], sim_round) % 5 - 2.0
+
+
+def new_mcts(**kwargs):
+    return MCTS(**{
+        "init_assistant": 'Hi, how are you feeling?',
+        "c": 1,
+        "sim_max_round": 2,
+        "gen_strategy_fn": gen_strategy,
+        "gen_assistant_fn": gen_assistant,
+        "gen_user_fn": gen_user,
+        "eval_all_fn": eval_all,
+        "render": 'never',
+    } | kwargs)
+
+
+def run(mcts, tmp_path, iterations):
+    mcts.run('description', 'scene', min_iter=iterations, min_end=10**9, max_iter=iterations, max_end=10**9, tmp_path=str(tmp_path))
+    return mcts
+
+
+def signature(node):
+    # everything saved about a tree, in preorder
+    nodes = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        nodes.append((node.strategy, node.strategy_score, int(node.N), float(node.Q), float(node.PUCB), bool(node.end), bool(node.is_extend),
+                      node.assistant if node.is_extend else None, node.user if node.is_extend else None, len(node.children)))
+        stack.extend(reversed(node.children))
+    return nodes
@@ -0,0 +1,40 @@
+import pytest
+
+import fake_tree
+from fake_tree import new_mcts
+
+
+PRIOR = {'Emotional Validation': 0.4, 'Affirmation': 0.35, 'Collaborative Planning': 0.25}
+
+
+def gen_strategy(history):
+    return [{"strategy": s, "score": p} for s, p in PRIOR.items()]
+
+
+def rewards(gap):
+    # 2 +- 0.4, plus gap when the first supporter turn after the opening used Affirmation
+    def eval_all(history, sim_round):
+        noise = (fake_tree._hash(history[-1]['content'], len(history)) % 81 - 40) / 100
+        return 2.0 + noise + (gap if history[2]['strategy'] == 'Affirmation' else 0)
+    return eval_all
+
+
+def search(tmp_path, gap, tree_store):
+    mcts = new_mcts(gen_strategy_fn=gen_strategy, eval_all_fn=rewards(gap), tree_store=tree_store,
+                    converge_patience=20, converge_min_iter=30, converge_delta=0.1, reward_range=4)
+    mcts.run('description', 'scene', min_iter=300, min_end=1, max_iter=300, max_end=10**9, tmp_path=str(tmp_path))
+    return mcts
+
+
+@pytest.mark.parametrize('tree_store', ['node', 'array'])
+def test_clear_winner_stops_early(tmp_path, tree_store):
+    mcts = search(tmp_path, 3, tree_store)
+    assert mcts.stop_reason == 'converged'
+    assert mcts.iter < 300
+    assert mcts.best_path()[1].strategy == 'Affirmation'
+
+
+def test_no_winner_runs_to_max_iter(tmp_path):
+    mcts = search(tmp_path, 0, 'node')
+    assert mcts.stop_reason == 'max_iter'
+    assert mcts.iter == 300
@@ -0,0 +1,40 @@
+import io
+import json
+
+import pytest
+
+import benchmark
+import build_data
+import change_data
+import change_data_kto
+import convert_data
+
+
+@pytest.fixture(scope='module')
+def records():
+    mcts = benchmark.synthetic_tree(3000)
+    data = [{"description": mcts.description, "scene": mcts.scene, "iter": mcts.iter, "messages": h} for h in build_data.build_compare(mcts)]
+    # repeated conversations are what the dedupe is for
+    return data + data[:len(data) // 2]
+
+
+def test_streaming_matches_legacy(records):
+    pair_out, kto_out = io.StringIO(), io.StringIO()
+    pair_dedupe, kto_dedupe = convert_data.convert(records, pair_out, kto_out)
+    pairs = [json.loads(line) for line in pair_out.getvalue().splitlines()]
+    kto = [json.loads(line) for line in kto_out.getvalue().splitlines()]
+    assert pairs == change_data.convert(records)
+    assert kto == change_data_kto.convert(records)
+    assert pair_dedupe.total > len(pair_dedupe.seen) == len(pairs)
+
+
+def test_compact_matches_legacy(records, tmp_path):
+    path = tmp_path / 'compact.jsonl'
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in convert_data.compact_records(records):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    pairs = convert_data.CompactDataset(str(path), 'pair')
+    kto = convert_data.CompactDataset(str(path), 'kto')
+    assert list(pairs) == change_data.convert(records)
+    assert list(kto) == change_data_kto.convert(records)
+    assert pairs[len(pairs) - 1] == change_data.convert(records)[-1]
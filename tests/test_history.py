@@ -0,0 +1,42 @@
+import pytest
+
+from fake_tree import new_mcts, run
+from util import History, history_to_str
+
+
+def full_render(history, strategy=False):
+    # history_to_str before it rendered incrementally
+    chat_history = ''
+    for h in history:
+        chat_history += f'seeker: {h["content"]}\n' if h['role'] == 'user' else 'supporter: ' + (f'({h["strategy"]}) ' if strategy else '') + f'{h["content"]}\n'
+    return chat_history[:-1]
+
+
+def extended_nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        stack.extend(node.children)
+        if node.is_extend:
+            yield node
+
+
+@pytest.mark.parametrize('tree_store', ['node', 'array'])
+def test_node_histories_render_like_the_full_history(tmp_path, tree_store):
+    mcts = run(new_mcts(tree_store=tree_store), tmp_path / 'tree', 15)
+    for node in extended_nodes(mcts.tree):
+        for strategy in (False, True):
+            history = node.build_history()
+            assert history_to_str(history, strategy) == full_render(history, strategy)
+            longer = history + [{"role": "supporter", "content": "more", "strategy": "Affirmation"}]
+            assert history_to_str(longer, strategy) == full_render(longer, strategy)
+            longer.append({"role": "user", "content": "and more"})
+            assert history_to_str(longer, strategy) == full_render(longer, strategy)
+            assert history_to_str(list(longer), strategy) == full_render(longer, strategy)
+
+
+def test_shortened_history_renders_from_scratch():
+    history = History([{"role": "user", "content": "a"}, {"role": "supporter", "content": "b", "strategy": "Affirmation"}, {"role": "user", "content": "c"}])
+    assert history_to_str(history, True) == full_render(history, True)
+    del history[1:]
+    assert history_to_str(history, True) == full_render(history, True) == 'seeker: a'
@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+from fake_tree import new_mcts, run, signature
+
+
+@pytest.mark.parametrize('tree_store', ['node', 'array'])
+@pytest.mark.parametrize('snapshot_every', [1000, 3])
+def test_replay_rebuilds_the_tree(tmp_path, tree_store, snapshot_every):
+    mcts = run(new_mcts(checkpoint='journal', snapshot_every=snapshot_every, tree_store=tree_store), tmp_path / 'tree', 12)
+    resumed = new_mcts(tree_store=tree_store)
+    resumed.load_tmp(str(tmp_path / 'tree.pkl'))
+    assert resumed.iter == mcts.iter == 12
+    assert signature(resumed.tree) == signature(mcts.tree)
+
+
+def test_unfinished_iteration_is_dropped(tmp_path):
+    mcts = run(new_mcts(checkpoint='journal'), tmp_path / 'tree', 5)
+    with open(tmp_path / 'tree.journal', 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"op": "backward", "path": [], "reward": 3.0, "seq": 10**6}) + '\n')
+        f.write('{"op": "iter", "it')
+    resumed = new_mcts()
+    resumed.load_tmp(str(tmp_path / 'tree.pkl'))
+    assert resumed.iter == 5
+    assert signature(resumed.tree) == signature(mcts.tree)
+
+
+@pytest.mark.parametrize('checkpoint', ['pickle', 'journal'])
+def test_resumed_run_matches_uninterrupted_run(tmp_path, checkpoint):
+    expected = run(new_mcts(checkpoint=checkpoint), tmp_path / 'straight', 12)
+    run(new_mcts(checkpoint=checkpoint, snapshot_every=4), tmp_path / 'resumed', 7)
+    resumed = run(new_mcts(checkpoint=checkpoint, snapshot_every=4), tmp_path / 'resumed', 12)
+    assert signature(resumed.tree) == signature(expected.tree)
@@ -0,0 +1,57 @@
+import pytest
+
+import treefile
+from MCTS import MCTS
+from fake_tree import new_mcts, run, signature
+
+
+@pytest.mark.parametrize('tree_store', ['node', 'array'])
+def test_round_trip(tmp_path, tree_store):
+    mcts = run(new_mcts(tree_store=tree_store), tmp_path / 'tmp', 15)
+    mcts.save(str(tmp_path / 'tree.tree'))
+    loaded = MCTS.load(str(tmp_path / 'tree.tree'))
+    assert signature(loaded.tree) == signature(mcts.tree)
+    assert (loaded.description, loaded.scene, loaded.iter, loaded.stop_reason, loaded.sim_max_round) == (mcts.description, mcts.scene, mcts.iter, mcts.stop_reason, mcts.sim_max_round)
+    assert loaded.get_best_json() == mcts.get_best_json()
+
+
+def test_matches_pickle_and_converts(tmp_path):
+    mcts = run(new_mcts(), tmp_path / 'tmp', 15)
+    mcts.save(str(tmp_path / 'tree.pkl'))
+    treefile.convert(str(tmp_path / 'tree.pkl'))
+    assert signature(MCTS.load(str(tmp_path / 'tree.tree')).tree) == signature(MCTS.load(str(tmp_path / 'tree.pkl')).tree)
+
+
+def test_stats_without_text(tmp_path):
+    mcts = run(new_mcts(tree_store='array'), tmp_path / 'tmp', 15)
+    mcts.save(str(tmp_path / 'tree.tree'))
+    meta, stats = treefile.load_stats(str(tmp_path / 'tree.tree'))
+    store = mcts.tree.store
+    assert meta["iter"] == 15
+    for name in treefile.STATS:
+        assert stats[name].tolist() == getattr(store, name)[:store.size].tolist()
+
+
+def test_loaded_tree_keeps_growing(tmp_path):
+    mcts = run(new_mcts(), tmp_path / 'tmp', 10)
+    mcts.save(str(tmp_path / 'a.tree'))
+    loaded = MCTS.load(str(tmp_path / 'a.tree'))
+    leaf = loaded.tree.select()
+    child = loaded._new_node(leaf, 'Affirmation', 0.5)
+    child.extend(assistant='new \u00e9', user=None, end=True)
+    leaf.children.append(child)
+    leaf.backward(1.5)
+    loaded.tree.store.user[0] = 'changed'
+    loaded.save(str(tmp_path / 'b.tree'))
+    assert signature(MCTS.load(str(tmp_path / 'b.tree')).tree) == signature(loaded.tree)
+
+
+def test_newer_version_is_rejected(tmp_path):
+    mcts = run(new_mcts(), tmp_path / 'tmp', 3)
+    path = tmp_path / 'tree.tree'
+    mcts.save(str(path))
+    data = path.read_bytes()
+    old = f'"version": {treefile.VERSION}'.encode()
+    path.write_bytes(data.replace(old, f'"version": {treefile.VERSION + 1}'.encode()[:len(old)], 1))
+    with pytest.raises(ValueError):
+        treefile.TreeFile(str(path))
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import mmap
+
+import numpy as np
+
+
+# <MAGIC><u64 header length><json header, padded to ALIGN><columns, each ALIGN aligned><utf-8 text blob>
+# offsets in the header are relative to the end of the padded header
+MAGIC = b'CSOTREE\x00'
+VERSION = 1
+ALIGN = 8
+EXT = '.tree'
+# saved TreeStore arrays; virtual_loss and pending only matter while a tree is being searched
+STATS = ("parent", "N", "Q", "PUCB", "strategy_score", "strategy_id", "end", "is_extend")
+
+
+class TextColumn:
+    # assistant or user text of every node, decoded from the mapped blob on access;
+    # texts written after loading (and appended nodes) are kept in memory
+    def __init__(self, blob, start, stop) -> None:
+        self.blob = blob
+        self.start = start
+        self.stop = stop
+        self.size = len(start)
+        self.changed: dict[int, str] = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        if idx in self.changed:
+            return self.changed[idx]
+        if idx >= len(self.start) or self.start[idx] < 0:
+            return None
+        return bytes(self.blob[self.start[idx]:self.stop[idx]]).decode('utf-8')
+
+    def __setitem__(self, idx, value):
+        self.changed[int(idx)] = value
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield self[idx]
+
+    def append(self, value):
+        self.changed[self.size] = value
+        self.size += 1
+
+    def __reduce__(self):
+        # pickled (e.g. into a tmp checkpoint) as a plain list, the mapping stays with this process
+        return list, (list(self),)
+
+
+def _text_columns(texts):
+    start = np.full(len(texts), -1, dtype=np.int64)
+    stop = np.full(len(texts), -1, dtype=np.int64)
+    chunks = []
+    offset = 0
+    for i, text in enumerate(texts):
+        if text is None:
+            continue
+        data = text.encode('utf-8')
+        start[i], stop[i] = offset, offset + len(data)
+        chunks.append(data)
+        offset += len(data)
+    return start, stop, chunks
+
+
+def write(path, meta, store):
+    # meta: json-serializable run info (description, scene, iter, ...), store: a TreeStore
+    size = store.size
+    columns = {name: np.ascontiguousarray(getattr(store, name)[:size]) for name in STATS}
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ch) for ch in store.children[:size]])
+    columns["child_offsets"] = offsets
+    columns["child_index"] = np.fromiter((i for ch in store.children[:size] for i in ch), dtype=np.int32, count=int(offsets[-1]))
+    chunks = []
+    for name in ("assistant", "user"):
+        start, stop, texts = _text_columns([getattr(store, name)[i] for i in range(size)])
+        columns[f"{name}_start"], columns[f"{name}_stop"] = start, stop
+        chunks.append(texts)
+
+    layout = {}
+    position = 0
+    for name, array in columns.items():
+        position += -position % ALIGN
+        layout[name] = {"dtype": array.dtype.str, "offset": position, "length": len(array)}
+        position += array.nbytes
+    # assistant offsets index the blob directly, user offsets follow them
+    assistant_bytes = sum(len(t) for t in chunks[0])
+    columns["user_start"][columns["user_start"] >= 0] += assistant_bytes
+    columns["user_stop"][columns["user_stop"] >= 0] += assistant_bytes
+    text_length = assistant_bytes + sum(len(t) for t in chunks[1])
+
+    header = json.dumps({
+        "version": VERSION,
+        "size": size,
+        "c": store.c,
+        "strategies": store.strategies,
+        "extra": {str(k): v for k, v in store.extra.items()},
+        "meta": meta,
+        "columns": layout,
+        "text": {"offset": position, "length": text_length},
+    }, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGN)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        written = 0
+        for name, array in columns.items():
+            f.write(b'\0' * (layout[name]["offset"] - written))
+            f.write(array.tobytes())
+            written = layout[name]["offset"] + array.nbytes
+        for texts in chunks:
+            for text in texts:
+                f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def is_tree_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TreeFile:
+    # read-only mapping of a tree file: header, numpy views of the columns and the text blob
+    def __init__(self, path) -> None:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a tree file')
+            length = int.from_bytes(f.read(8), 'little')
+            self.header = json.loads(f.read(length))
+            if self.header["version"] > VERSION:
+                raise ValueError(f'{path} has tree format version {self.header["version"]}, this reader knows up to {VERSION}')
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = len(MAGIC) + 8 + length
+
+    @property
+    def meta(self):
+        return self.header["meta"]
+
+    def column(self, name):
+        spec = self.header["columns"][name]
+        return np.frombuffer(self.map, dtype=np.dtype(spec["dtype"]), count=spec["length"], offset=self.base + spec["offset"])
+
+    def stats(self):
+        # every statistic column without touching the dialogue text
+        return {name: self.column(name) for name in STATS}
+
+    def children(self):
+        offsets, index = self.column("child_offsets").tolist(), self.column("child_index").tolist()
+        return [index[offsets[i]:offsets[i + 1]] for i in range(self.header["size"])]
+
+    def text(self, name):
+        blob = memoryview(self.map)[self.base + self.header["text"]["offset"]:]
+        return TextColumn(blob, self.column(f"{name}_start"), self.column(f"{name}_stop"))
+
+
+def load_stats(path):
+    # (meta, {column: array}) for scanning many trees by Q / N / end
+    tree = TreeFile(path)
+    return tree.meta, tree.stats()
+
+
+def convert(src, dst=None):
+    # .pkl file -> .tree file next to it (or dst), a folder converts every .pkl inside it
+    from MCTS import MCTS
+    if os.path.isdir(src):
+        for name in sorted(os.listdir(src)):
+            if name.endswith('.pkl'):
+                convert(os.path.join(src, name), os.path.join(dst, os.path.splitext(name)[0] + EXT) if dst else None)
+        return
+    dst = dst or os.path.splitext(src)[0] + EXT
+    MCTS.load(src).save(dst)
+    print(f'{src} -> {dst}')
+
+
+if __name__ == '__main__':
+    convert(*sys.argv[1:3])
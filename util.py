@@ -1,62 +1,362 @@
 import os
 import json
 import time
+import random
+import asyncio
 import functools
+import threading
+import contextvars
+from email.utils import parsedate_to_datetime
 
-from openai import OpenAI
-from dotenv import load_dotenv
+from cache import ResponseCache
+from ratelimit import RateLimiter
+import metrics
 
 
 
-load_dotenv()
+# .env, the settings below and the openai package are all loaded by setup() on the first generate(),
+# so importing util (e.g. through MCTS for offline tree work) needs no credentials and no network stack
+_ready = False
+_setup_lock = threading.Lock()
 
-openai = OpenAI(
-    api_key=os.getenv('openai_key'),
-    base_url=os.getenv('openai_url'),
-)
+# created on first generate()
+openai = None
 
-def generate(query, system = None):
+MODEL = None
+# 'sync': one blocking request per calling thread; 'async': requests from every thread are multiplexed on one event loop;
+# 'batch': requests from every thread are collected into batch files (see batch.from_env), callers wait for their batch
+BACKEND = None
+CONCURRENCY = None
+# llm_cache: sqlite file for responses, llm_cache_mode: 'rw' or 'ro', llm_cache_max_mb: evict least recently used above this size
+cache = None
+# process-wide quota shared by every generate() caller, 0 turns a limit off;
+# openai_rate_share > 1 (set by the scheduler for its worker processes) gives this process that fraction of openai_rpm / openai_tpm
+limiter = None
+# completion tokens assumed per request until the API reports real usage
+OUTPUT_TOKENS = 256
+
+# set by retry() so a cached response that failed to parse is regenerated instead of replayed
+_refresh_cache = contextvars.ContextVar('refresh_cache', default=False)
+# cache keys looked up during the current retry() attempt, dropped again when the attempt fails to parse
+_attempt_keys = contextvars.ContextVar('attempt_keys', default=None)
+
+_loop = None
+_loop_lock = threading.Lock()
+_async_clients = {}
+_batch = None
+
+
+def setup():
+    global _ready, MODEL, BACKEND, CONCURRENCY, cache, limiter
+    if _ready:
+        return
+    with _setup_lock:
+        if _ready:
+            return
+        from dotenv import load_dotenv
+        load_dotenv()
+        MODEL = os.getenv('openai_model', 'gpt-4o-mini')
+        BACKEND = os.getenv('openai_backend', 'sync')
+        CONCURRENCY = int(os.getenv('openai_concurrency', 256))
+        cache = ResponseCache(
+            os.getenv('llm_cache'),
+            max_bytes=int(float(os.getenv('llm_cache_max_mb')) * 2**20) if os.getenv('llm_cache_max_mb') else None,
+            read_only=os.getenv('llm_cache_mode', 'rw') == 'ro',
+        ) if os.getenv('llm_cache') else None
+        share = int(os.getenv('openai_rate_share', 1))
+        limiter = RateLimiter(rpm=int(os.getenv('openai_rpm', 0)) / share, tpm=int(os.getenv('openai_tpm', 0)) / share)
+        _ready = True
+
+def build_messages(query, system = None):
+    msg = [{"role": "user", "content": query}]
+    if system:
+        msg.insert(0, {"role": "system", "content": system})
+    return msg
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='llm-loop', daemon=True).start()
+    return _loop
+
+def _async_client():
+    # one pooled client and concurrency limit per event loop
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        from openai import AsyncOpenAI
+        _async_clients[loop] = (
+            AsyncOpenAI(api_key=os.getenv('openai_key'), base_url=os.getenv('openai_url'), max_retries=0),
+            asyncio.Semaphore(CONCURRENCY),
+        )
+    return _async_clients[loop]
+
+def _batcher():
+    global _batch
+    with _loop_lock:
+        if _batch is None:
+            import batch
+            _batch = batch.from_env(MODEL, cache)
+    return _batch
+
+def _batch_complete(query, system, params, key=None):
+    # the collector stores the answer under key itself, so it survives a restart while the batch is out
+    start = time.perf_counter()
+    try:
+        body = _batcher().submit(build_messages(query, system), params, key).result()
+    except Exception:
+        metrics.inc('failures')
+        raise
+    usage = body.get('usage') or {}
+    metrics.observe(time.perf_counter() - start, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+    return body['choices'][0]['message']['content']
+
+def _estimate_tokens(query, system):
+    return (len(query) + len(system or '')) // 4 + OUTPUT_TOKENS
+
+def _charge_usage(estimate, chat_completion, seconds):
+    usage = getattr(chat_completion, 'usage', None)
+    if usage is not None:
+        limiter.correct(usage.total_tokens - estimate)
+    metrics.observe(seconds, usage.prompt_tokens if usage else 0, usage.completion_tokens if usage else 0)
+
+def _cache_lookup(query, system, params):
+    if cache is None:
+        return None, None
+    key = ResponseCache.key(MODEL, system, query, params)
+    if _attempt_keys.get() is not None:
+        _attempt_keys.get().append(key)
+    if _refresh_cache.get():
+        return key, None
+    output = cache.get(key)
+    if output is not None:
+        metrics.inc('cache_hits')
+    return key, output
+
+def _cache_store(key, output):
+    if cache is not None:
+        cache.put(key, output)
+
+async def _acomplete(query, system, params):
+    client, semaphore = _async_client()
+    estimate = _estimate_tokens(query, system)
+    await limiter.aacquire(estimate)
+    async with semaphore:
+        start = time.perf_counter()
+        try:
+            chat_completion = await client.chat.completions.create(
+                model=MODEL,
+                messages=build_messages(query, system),
+                stream=False,
+                **params,
+            )
+        except Exception:
+            metrics.inc('failures')
+            raise
+    _charge_usage(estimate, chat_completion, time.perf_counter() - start)
+    return chat_completion.choices[0].message.content
+
+async def agenerate(query, system = None, **params):
+    # direct async callers get the same backoff on transient API errors that retry() gives generate() callers
+    return await _agenerate(query, system, params)
+
+def generate(query, system = None, **params):
+    setup()
+    key, output = _cache_lookup(query, system, params)
+    if output is not None:
+        return output
+    if BACKEND == 'batch':
+        return _batch_complete(query, system, params, key)
+    if BACKEND == 'async':
+        # the loop thread has its own context, so the caller's metric role and scopes go along explicitly
+        coro = metrics.in_context(_acomplete)(query, system, params)
+        output = asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+        _cache_store(key, output)
+        return output
     global openai
-    if openai.is_closed():
+    if openai is None or openai.is_closed():
+        from openai import OpenAI
         openai = OpenAI(
         api_key=os.getenv('openai_key'),
         base_url=os.getenv('openai_url'),
+        max_retries=0,
     )
-    msg = [{"role": "user", "content": query}]
-    if system:
-        msg.insert(0, {"role": "system", "content": system})
-    chat_completion = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=msg,
-        stream=False,
-    )
-    return chat_completion.choices[0].message.content
+    estimate = _estimate_tokens(query, system)
+    limiter.acquire(estimate)
+    start = time.perf_counter()
+    try:
+        chat_completion = openai.chat.completions.create(
+            model=MODEL,
+            messages=build_messages(query, system),
+            stream=False,
+            **params,
+        )
+    except Exception:
+        metrics.inc('failures')
+        raise
+    _charge_usage(estimate, chat_completion, time.perf_counter() - start)
+    output = chat_completion.choices[0].message.content
+    _cache_store(key, output)
+    return output
+
+def is_api_error(e: Exception):
+    from openai import APIStatusError, APIConnectionError
+    from batch import BatchError
+    return isinstance(e, (APIStatusError, APIConnectionError, BatchError))
+
+def is_transient(e: Exception):
+    from openai import APIStatusError, APIConnectionError
+    from batch import BatchError, BatchTimeout
+    if isinstance(e, BatchTimeout):
+        return False
+    if isinstance(e, (APIStatusError, BatchError)):
+        # a batch line without a status (expired, missing) is sent again with the next batch
+        return e.status_code is None or e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, APIConnectionError)
 
-def retry(max_attempts=None, delay=1):
+def retry_after(e: Exception):
+    headers = getattr(getattr(e, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _retry_wait(e, attempts, parse_failures, role, max_attempts, delay, max_delay, parse_attempts):
+    # (attempts, parse_failures, seconds to wait) after a failed call, None when e should be raised
+    print('err:', e, '\n')
+    if is_api_error(e):
+        if not is_transient(e):
+            return None
+        attempts += 1
+        if max_attempts is not None and attempts >= max_attempts:
+            return None
+        wait = retry_after(e)
+        if wait is not None:
+            limiter.pause(wait)
+        else:
+            wait = min(max_delay, delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+    else:
+        metrics.inc('parse_failures', role=role)
+        # an answer that did not parse is not replayed by a later run either
+        if cache is not None:
+            for key in _attempt_keys.get() or ():
+                cache.delete(key)
+        parse_failures += 1
+        if parse_failures >= parse_attempts:
+            return None
+        wait = delay
+    metrics.inc('retries', role=role)
+    return attempts, parse_failures, wait
+
+def retry(max_attempts=None, delay=1, max_delay=60, parse_attempts=10, role=None):
+    # role labels the metrics of every generate() call made inside func
+    # transient API errors back off exponentially with jitter (max_attempts, None for no limit),
+    # other API errors are raised at once, and anything else (bad output that failed to parse) is retried parse_attempts times
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             attempts = 0
-            while max_attempts is None or attempts < max_attempts:
+            parse_failures = 0
+            while True:
+                token = _refresh_cache.set(attempts + parse_failures > 0)
+                keys_token = _attempt_keys.set([])
+                try:
+                    with metrics.role(role or metrics.current_role()):
+                        return func(*args, **kwargs)
+                except Exception as e:
+                    state = _retry_wait(e, attempts, parse_failures, role, max_attempts, delay, max_delay, parse_attempts)
+                    if state is None:
+                        raise
+                    attempts, parse_failures, wait = state
+                finally:
+                    _refresh_cache.reset(token)
+                    _attempt_keys.reset(keys_token)
+                if wait > 0:
+                    time.sleep(wait)
+        return wrapper
+    return decorator
+
+def aretry(max_attempts=None, delay=1, max_delay=60, parse_attempts=10, role=None):
+    # retry() for coroutine functions, waits with asyncio.sleep instead of blocking the loop
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempts = 0
+            parse_failures = 0
+            while True:
+                token = _refresh_cache.set(attempts + parse_failures > 0)
+                keys_token = _attempt_keys.set([])
                 try:
-                    return func(*args, **kwargs)
+                    with metrics.role(role or metrics.current_role()):
+                        return await func(*args, **kwargs)
                 except Exception as e:
-                    print('err:', e, '\n')
-                    last_exception = e
-                    attempts += 1
-                    if delay > 0:
-                        time.sleep(delay)
-            raise last_exception
+                    state = _retry_wait(e, attempts, parse_failures, role, max_attempts, delay, max_delay, parse_attempts)
+                    if state is None:
+                        raise
+                    attempts, parse_failures, wait = state
+                finally:
+                    _refresh_cache.reset(token)
+                    _attempt_keys.reset(keys_token)
+                if wait > 0:
+                    await asyncio.sleep(wait)
         return wrapper
     return decorator
 
+@aretry(parse_attempts=1)
+async def _agenerate(query, system, params):
+    setup()
+    key, output = _cache_lookup(query, system, params)
+    if output is not None:
+        return output
+    output = await _acomplete(query, system, params)
+    _cache_store(key, output)
+    return output
+
+
+class History(list):
+    # dialogue list that remembers what history_to_str already rendered, so appending a turn only renders that turn
+    def __init__(self, turns=(), rendered=None, base=None):
+        super().__init__(turns)
+        self.rendered = dict(rendered or {})
+        # (turn count, strategy -> rendered text of those turns) from the tree node this history was built from
+        self.base = base
+
+    def __add__(self, other):
+        return History(list.__add__(self, other), self.rendered, self.base)
+
+    def copy(self):
+        return History(self, self.rendered, self.base)
+
+
+def render_turn(h, strategy=False):
+    return f'seeker: {h["content"]}\n' if h['role'] == 'user' else 'supporter: ' + (f'({h["strategy"]}) ' if strategy else '') + f'{h["content"]}\n'
 
 def history_to_str(history, strategy=False) -> bool:
-    chat_history = ''
-    for h in history:
-        chat_history += f'seeker: {h["content"]}\n' if h['role'] == 'user' else 'supporter: ' + (f'({h["strategy"]}) ' if strategy else '') + f'{h["content"]}\n'
-    chat_history = chat_history[:-1]
-    return chat_history
+    if not isinstance(history, History):
+        return ''.join(render_turn(h, strategy) for h in history)[:-1]
+    n, chat_history = history.rendered.get(strategy, (0, ''))
+    if n == 0 and history.base is not None and history.base[0] <= len(history):
+        n, chat_history = history.base[0], history.base[1](strategy)
+    if n > len(history):
+        n, chat_history = 0, ''
+    chat_history += ''.join(render_turn(h, strategy) for h in history[n:])
+    history.rendered[strategy] = (len(history), chat_history)
+    return chat_history[:-1]
 
 def as_bool(v: str | bool):
     if type(v) == bool: